@@ -1,11 +1,22 @@
 from __future__ import print_function
 from functools import wraps
+import contextlib
 import inspect
 import copy
 import os
-import string
+import re
 import json
 from json import encoder
+import threading
+
+import bond_background
+import bond_cassette
+import bond_flight_recorder
+import bond_memoize
+import bond_normalize
+import bond_profile
+import bond_store
+import bond_table
 
 
 # Special result from spy when no agent matches, or no agent provides a result
@@ -23,7 +34,17 @@ def start_test(current_python_test,
                observation_directory=None,
                reconcile=None,
                spy_groups=None,
-               decimal_precision=None):
+               decimal_precision=None,
+               profile=None,
+               trace=None,
+               cassette=None,
+               memoize_on_disk=None,
+               normalizers=None,
+               collapse_repeats=None,
+               observation_store=None,
+               compress_threshold=None,
+               prefetch=None,
+               write_behind=None):
     """
     This function should be called in a ``unittest.TestCase`` before any
     of the other Bond functions can be used. This will initialize the Bond
@@ -40,7 +61,8 @@ def start_test(current_python_test,
     :param current_python_test: the instance of ``unittest.TestCase`` that is running. This is the
            only mandatory parameter. Bond uses this parameter to obtain good values for
            the other optional parameters, and also to know when the test ends,
-           to activate the observation comparison.
+           to activate the observation comparison. For pytest test functions, use instead the ``bond`` fixture
+           of :py:mod:`bond.pytest_plugin`.
     :param test_name: (optional) the name of the test. By default, it is ``TestCase.testName``.
     :param observation_directory: (optional) the directory where the observation files are stored.
            By default this is the ``test_observations`` subdirectory in the
@@ -65,17 +87,104 @@ def start_test(current_python_test,
     :param decimal_precision: (optional) the precision (number of decimal places) to use when
            serializing float values. Defaults to 4.
 
+    :param profile: (optional) if True, then collect, for each spy point, the number of calls and a
+           histogram of the time spent in the spied function, along with the time spent by Bond itself.
+           A report is printed at the end of the test, and another one for the whole session when the
+           process exits. The profile is not part of the observations.
+
+    :param trace: (optional) if True, then record the begin and end time of each spy point invocation, and
+           save them at the end of the test in the Chrome trace-event format, in a file next to the
+           observation file (with the ``.trace.json`` extension). The trace can be opened with
+           ``chrome://tracing``. The trace is not part of the observations.
+
+    :param cassette: (optional) use a cassette for the spy points with ``require_agent_result``, when no
+           agent provides a result. The cassette is stored next to the observation file (with the
+           ``.cassette.json`` extension). By default the value of the environment variable
+           ``BOND_CASSETTE`` is used, or if missing, no cassette is used.
+
+           * ``record`` (invoke the real function, and record its result in the cassette)
+           * ``replay`` (serve the results from the cassette, as if an agent provided them)
+
+           The results must be JSON serializable, and are returned after a round trip through JSON in
+           both modes, e.g., tuples become lists.
+
+    :param memoize_on_disk: (optional) if True, then the results of the spy points with ``memoize=True`` are
+           also stored on disk, in the ``.bond_memoize`` subdirectory of the observation directory, so that
+           they are reused across sessions. The store is bounded in size, evicting the least recently used
+           results.
+
+    :param normalizers: (optional) a list of rules to replace volatile values, such as memory addresses,
+           names of temporary files, timestamps or process ids, with stable placeholders in the observations.
+           A rule is either the name of a standard rule (``address``, ``tmp_file``, ``timestamp``,
+           ``pid``), or a pair of a regular expression and a replacement, or a pair of a type and a
+           replacement. In a replacement string ``{n}`` is the order in which the distinct values were first
+           seen in the test. See :py:mod:`bond.bond_normalize`. For example,
+           ``normalizers=['address', (r'session=\w+', 'session={n}'), (datetime.datetime, '<now>')]``.
+
+    :param collapse_repeats: (optional) if True, then consecutive identical observations are saved as one
+           observation, with an additional ``__repeat__`` key holding the number of occurrences. This is useful
+           for polling loops. The comparison is done before formatting, so the repeated observations are
+           not formatted or stored. This can be overridden for a spy point with :py:func:`deploy_agent`.
+
+    :param observation_store: (optional) where to store the reference observations. By default the value of the
+           environment variable ``BOND_OBSERVATION_STORE`` is used, or if missing, the default is ``files``.
+
+           * ``files`` (one file per test, in a directory tree derived from the test name)
+           * ``sqlite`` (one SQLite database, ``bond_observations.sqlite`` in the observation directory, with
+             batched writes). Run ``bond_store.py export`` to get the file layout, e.g., for reviewing the
+             changes, and ``bond_store.py import`` to bring the files back into the database.
+
+    :param compress_threshold: (optional) the size in bytes from which the reference observation files are
+           written compressed with gzip, with the ``.json.gz`` extension. By default the value of the environment
+           variable ``BOND_COMPRESS_THRESHOLD`` is used, or if missing, the files are not compressed. Compressed
+           reference files (``.json.gz`` or ``.json.bz2``) are always recognized when reading, and they are compared
+           with the current observations as they are decompressed.
+
+    :param prefetch: (optional) if True, then the reference observation file is read on a background thread
+           when the test starts, and is decompressed if needed, so that it is ready by the time the observations
+           are reconciled. By default, prefetching is used if the environment variable ``BOND_PREFETCH`` is set
+           to ``1``. The statistics of the prefetching are returned by :py:func:`bond.bond_store.prefetch_stats`.
+           Only for the ``files`` observation store.
+
+    :param write_behind: (optional) if True, then when the test ends its observations are handed to a background
+           thread, which compares them with the reference and saves them, while the next test runs. Only for the
+           ``accept`` and ``abort`` reconcile methods. The differences are then reported at the end of the session,
+           when :py:func:`finish_session` fails with the list of the tests whose observations differ. You must call
+           :py:func:`finish_session` for the differences to fail the test run, unless you use the pytest plugin,
+           which calls it. By default,
+           the value of the environment variable ``BOND_WRITE_BEHIND`` is used (``1`` to enable).
+
     """
     Bond.instance().start_test(current_python_test, test_name=test_name,
                                observation_directory=observation_directory,
                                reconcile=reconcile, spy_groups=spy_groups,
-                               decimal_precision=decimal_precision)
+                               decimal_precision=decimal_precision,
+                               profile=profile,
+                               trace=trace,
+                               cassette=cassette,
+                               memoize_on_disk=memoize_on_disk,
+                               normalizers=normalizers,
+                               collapse_repeats=collapse_repeats,
+                               observation_store=observation_store,
+                               compress_threshold=compress_threshold,
+                               prefetch=prefetch,
+                               write_behind=write_behind)
 
 
 def settings(observation_directory=None,
              reconcile=None,
              spy_groups=None,
-             decimal_precision=None):
+             decimal_precision=None,
+             profile=None,
+             trace=None,
+             cassette=None,
+             memoize_on_disk=None,
+             normalizers=None,
+             collapse_repeats=None,
+             observation_store=None,
+             compress_threshold=None,
+             prefetch=None,
+             write_behind=None):
     """
     Override settings that were set in :py:func:`start_test`. Only apply for the duration
     of a test, so this should be called after :py:func:`start_test`. This
@@ -105,11 +214,47 @@ def settings(observation_directory=None,
     :param decimal_precision: (optional) the precision (number of decimal places) to use when
            serializing float values. Defaults to 4.
 
+    :param profile: (optional) if True, then profile the spy points. See :py:func:`start_test`.
+
+    :param trace: (optional) if True, then save a trace of the spy points. See :py:func:`start_test`.
+
+    :param cassette: (optional) ``record`` or ``replay`` the results of spy points that require an agent
+           result. See :py:func:`start_test`.
+
+    :param memoize_on_disk: (optional) if True, then store memoized results on disk.
+           See :py:func:`start_test`.
+
+    :param normalizers: (optional) a list of rules to replace volatile values with stable placeholders.
+           See :py:func:`start_test`.
+
+    :param collapse_repeats: (optional) if True, then collapse consecutive identical observations.
+           See :py:func:`start_test`.
+
+    :param observation_store: (optional) ``files`` or ``sqlite``. See :py:func:`start_test`.
+
+    :param compress_threshold: (optional) the size in bytes from which to compress the reference files.
+           See :py:func:`start_test`.
+
+    :param prefetch: (optional) if True, then read the reference file in the background.
+           See :py:func:`start_test`.
+
+    :param write_behind: (optional) if True, then finish the test in the background. See :py:func:`start_test`.
+
     """
     Bond.instance().settings(observation_directory=observation_directory,
                              reconcile=reconcile,
                              spy_groups=spy_groups,
-                             decimal_precision=decimal_precision)
+                             decimal_precision=decimal_precision,
+                             profile=profile,
+                             trace=trace,
+                             cassette=cassette,
+                             memoize_on_disk=memoize_on_disk,
+                             normalizers=normalizers,
+                             collapse_repeats=collapse_repeats,
+                             observation_store=observation_store,
+                             compress_threshold=compress_threshold,
+                             prefetch=prefetch,
+                             write_behind=write_behind)
 
 
 def active():
@@ -172,6 +317,115 @@ def spy(spy_point_name=None, skip_save_observation=False, **kwargs):
                                **kwargs)
 
 
+def spy_table(spy_point_name, rows, columns=None, sort_key=None, **kwargs):
+    """
+    Spy a table, e.g., a list of records. The table is saved in the ``__table__`` key of the observation, as
+    the list of the column names, followed by the list of the cells of each row. In the reference file, each row
+    is shown on one line, and the reconcile describes the differences in the table row by row.
+
+    .. code::
+
+         bond.spy_table('buses', buses, columns=['id', 'lat', 'lon', 'away'], sort_key='id')
+
+    :param spy_point_name: the spy point name, as for :py:func:`spy`
+    :param rows: a list of dictionaries, or of sequences with the cells in the order of the columns
+    :param columns: the list of the column names. By default, the sorted keys of the rows, which must then be
+           dictionaries
+    :param sort_key: if not None, the rows are sorted, in a stable way, by this key: a column name, a list of
+           column names, or a function that is given the row as a dictionary
+    :param kwargs: other key-value pairs to spy, along with the table
+    :return: the result of :py:func:`spy` for the observation
+    """
+    return Bond.instance().spy_table(spy_point_name, rows, columns=columns, sort_key=sort_key, **kwargs)
+
+
+def spy_many(spy_point_name, rows):
+    """
+    Record a batch of observations for a spy point, one for each row, as if :py:func:`spy` was called for
+    each of them, but at a fraction of the overhead. The agents for the spy point are looked up once for
+    the batch, and when no agent applies to the rows, the rows are copied and serialized in one pass.
+
+    .. code::
+
+         bond.spy_many('bus', [dict(id=bus.id, lat=bus.lat, lon=bus.lon) for bus in buses])
+
+    :param spy_point_name: the spy point name, as for :py:func:`spy`. May be None.
+    :param rows: an iterable of dictionaries, each with the key-value pairs for one observation
+    :return: the list of the results of :py:func:`spy` for the rows, or None if we are not testing
+    """
+    return Bond.instance().spy_many(spy_point_name, rows)
+
+
+@contextlib.contextmanager
+def unordered():
+    """
+    A context manager for a region of code whose observations may be produced in a
+    nondeterministic order, e.g., by a pool of worker threads. When the region ends, its
+    observations are sorted in a canonical order, so that they are compared as a multiset.
+
+    .. code::
+
+        with bond.unordered():
+            pool.map(process_item, items)
+
+    Regions can be nested. Outside of a test this does nothing.
+    """
+    the_bond = Bond.instance()
+    start = the_bond.begin_unordered()
+    try:
+        yield
+    finally:
+        the_bond.end_unordered(start)
+
+
+def finish_session():
+    """
+    Wait for the tests that are finishing in the background, with the ``write_behind`` setting, and fail
+    if the observations of any of them differ from the reference. Call this at the end of the test session,
+    e.g., in ``tearDownModule``. Otherwise, the differences are only reported when the process exits, and
+    they do not change its exit status.
+
+    :return: the number of tests that were finished in the background
+    """
+    return bond_background.finish_session()
+
+
+@contextlib.contextmanager
+def bind_session(session=None):
+    """
+    A context manager that binds a Bond session to the current thread, so that the Bond functions,
+    and the spy points reached in this thread, use it instead of the global session. This allows
+    independent tests to run concurrently in one process, each in its own thread, e.g.,
+
+    .. code::
+
+        def run_tests_in_thread(tests, result):
+            with bond.bind_session():
+                tests.run(result)
+
+    The threads started by a test use the global session. To spy in them, bind the session of the
+    test, obtained with :py:func:`current_session`.
+
+    :param session: (optional) the session to bind. By default, a new session.
+    :return: the session
+    """
+    if session is None:
+        session = Bond()
+    previous_session = getattr(Bond._bound, 'session', None)
+    Bond._bound.session = session
+    try:
+        yield session
+    finally:
+        Bond._bound.session = previous_session
+
+
+def current_session():
+    """
+    The Bond session for the current thread. See :py:func:`bind_session`.
+    """
+    return Bond.instance()
+
+
 def deploy_agent(spy_point_name, **kwargs):
     """
     Create and deploy a new agent for the named spy point. When a spy point is encountered, the agents are searched
@@ -200,6 +454,12 @@ def deploy_agent(spy_point_name, **kwargs):
           * filter=func : only when the given func returns true when passed observation dictionary.
             The function should not make changes to the observation dictionary.
             Uses the observation before formatting.
+          * when=func : only for the calls of a :py:func:`spy_point` for which the given func returns true
+            when passed the arguments of the call, as for the ``when`` parameter of :py:func:`spy_point`.
+            The guard is evaluated before the observation dictionary is built. If the guards reject
+            a call for all the agents of a spy point without its own ``when`` and without
+            ``require_agent_result``, the call is not spied at all: the function is invoked directly.
+            This key applies only to spy points, not to the direct calls to :py:func:`spy`.
 
         * Keys that control what the observer does when processed:
 
@@ -229,6 +489,8 @@ def deploy_agent(spy_point_name, **kwargs):
             calls to e.g. certain functions whose call order may not be relevant. This will override any
             value of ``mock_only`` specified on a :py:func:`spy_point` or value of ``skip_save_observation``
             specified on a call to :py:func:`spy`, meaning you can also specify a value of False to override.
+          * collapse_repeats : if specified, overrides the ``collapse_repeats`` setting
+            (see :py:func:`start_test`) for the calls to spy for which this agent is active.
 
     :return: nothing
     """
@@ -240,7 +502,11 @@ def spy_point(spy_point_name=None,
               mock_only=False,
               require_agent_result=False,
               excluded_keys=('self',),
-              spy_result=False):
+              spy_result=False,
+              memoize=False,
+              when=None,
+              include_keys=None,
+              formatters=None):
     """
     Function and method decorator for spying arguments and results of methods. This decorator is safe
     to use on production code. It will have effects only if the function :py:func:`start_test` has
@@ -277,9 +543,38 @@ def spy_point(spy_point_name=None,
                            invoking shell commands, or requesting user input.
     :param excluded_keys: (optional) a tuple or list of parameter key names to skip when saving the observations.
                          Further manipulation of what gets observed can be done from agents.
+    :param include_keys: (optional) a tuple or list of parameter key names to observe. If given, the other
+                         parameters are not observed, as if they were in ``excluded_keys``, which still applies.
+    :param formatters: (optional) a dictionary from parameter key names to the spec of a formatter for the
+                         value of the parameter, e.g., ``'len'``, ``'hash'``, ``'truncate(200)'``,
+                         ``'round(2)'``, a function, or a list of these (see
+                         :py:func:`bond.bond_helpers.format_at.value_formatter`). The formatters are compiled
+                         when the function is decorated.
+
+                         .. code::
+
+                             @bond.spy_point(include_keys=('url', 'body'),
+                                             formatters=dict(url='truncate(80)', body=['len']))
+                             def post(self, url, headers, body):
+
+                         The keys are selected and the values are formatted before the observation is copied,
+                         so large arguments are never copied. The agents see the formatted values.
     :param spy_result: (optional) if True, then the result value is spied also, using a spy_point name of
                        `spy_point_name.result`. If there is an agent providing a result for
                        this spy point, then the agent result is saved as the observation.
+    :param memoize: (optional) if True, then during tests the results of this function are memoized,
+                       keyed on the canonical serialization of the observed arguments, and on a hash of the
+                       source of the function. Use this only for pure functions that are expensive to run.
+                       The memoized results are kept in memory for all the tests in the session, and
+                       also on disk if the ``memoize_on_disk`` setting is True. The calls are observed
+                       as usual, whether or not the result is memoized.
+    :param when: (optional) a guard, to spy only some of the calls: a function that is given the same arguments
+                       as the decorated function, including ``self`` for methods, and returns true for the calls
+                       to spy. It is evaluated before the observation dictionary is built, and the calls that it
+                       rejects invoke the function directly, without observations or agents. Use this for hot
+                       functions of which only a few calls are interesting. The guard is ignored for the spy
+                       points with ``require_agent_result``, which are always spied. Agents may have guards
+                       also, with the ``when`` key of :py:func:`deploy_agent`.
     """
     # TODO: Should we also have an excluded_from_groups parameter?
     # TODO right now excluding 'self' using excludedKeys, should attempt to find a better way?
@@ -299,66 +594,117 @@ def spy_point(spy_point_name=None,
             assert isinstance(enabled_for_groups, (list, tuple))
             enabled_for_groups_local = enabled_for_groups
 
-        @wraps(fn)
-        def fn_wrapper(*args, **kwargs):
-            # Bypass spying if we are not TESTING
-            if not active():
-                return fn(*args, **kwargs)
-            the_bond = Bond.instance()
-            if enabled_for_groups_local is not None:
-                for grp in enabled_for_groups_local:
-                    if grp in the_bond.spy_groups:
-                        break
-                else:
-                    # We are only enabled for some groups, but none of those and active
-                    return fn(*args, **kwargs)
-
-            arginfo = inspect.getargspec(fn)
-            callargs = inspect.getcallargs(fn, *args, **kwargs)
-            if spy_point_name is None:
-                # We recognize instance methods by the first argument 'self'
-                # TODO: there must be a better way to do this
-                spy_point_name_local = None
-                if arginfo and arginfo[0]:
-                    if arginfo[0][0] == 'self':
-                        spy_point_name_local = args[0].__class__.__name__ + '.' + fn.__name__
-                    elif arginfo[0][0] == 'cls':
-                        # A class method
-                        spy_point_name_local = args[0].__name__ + '.' + fn.__name__
-                if spy_point_name_local is None:
-                    # TODO We get here both for staticmethod and for module-level functions
-                    # If we had the spy_point wrapper outside the @staticmethod we could tell
-                    # more easily what kind of method this was !!
-                    module_name = getattr(fn, '__module__')
-                    if module_name == '__main__':  # Get the original module name from the filename
-                        module_name = os.path.splitext(os.path.basename(inspect.getmodule(fn).__file__))[0]
-                    # Keep only the last component of the name
-                    module_name = module_name.split('.')[-1]
-                    spy_point_name_local = module_name + '.' + fn.__name__
-            else:
-                spy_point_name_local = spy_point_name
+        arginfo = inspect.getargspec(fn)
 
+        # The keys to observe, and the formatters of their values
+        observed_keys = (frozenset(key for key in include_keys if key not in excluded_keys)
+                         if include_keys is not None else None)
+        if formatters:
+            from bond_helpers.format_at import value_formatter
+            value_formatters = [(key, value_formatter(spec)) for key, spec in formatters.iteritems()]
+        else:
+            value_formatters = ()
+
+        def spy_point_name_for_call(args):
+            if spy_point_name is not None:
+                return spy_point_name
+            # We recognize instance methods by the first argument 'self'
+            # TODO: there must be a better way to do this
+            if arginfo and arginfo[0]:
+                if arginfo[0][0] == 'self':
+                    return args[0].__class__.__name__ + '.' + fn.__name__
+                elif arginfo[0][0] == 'cls':
+                    # A class method
+                    return args[0].__name__ + '.' + fn.__name__
+            # We get here both for staticmethod and for module-level functions, because we cannot tell
+            # the class of a static method from its function. Use spy_class, or spy_point_name,
+            # to name the spy points of static methods after their class.
+            module_name = getattr(fn, '__module__')
+            if module_name == '__main__':  # Get the original module name from the filename
+                module_name = os.path.splitext(os.path.basename(inspect.getmodule(fn).__file__))[0]
+            # Keep only the last component of the name
+            module_name = module_name.split('.')[-1]
+            return module_name + '.' + fn.__name__
+
+        def make_argument_dictionary(args, kwargs):
+            # The arguments of the call, except the excluded_keys, before include_keys and formatters
             observation_dictionary = {}
 
             varargs_name = arginfo.varargs
             for idx in range(0, min(len(args), len(arginfo.args))):
                 observation_dictionary[arginfo.args[idx]] = args[idx]
-            if varargs_name is not None and len(callargs[varargs_name]) != 0:
-                observation_dictionary[varargs_name] = callargs[varargs_name]
+            if varargs_name is not None and len(args) > len(arginfo.args):
+                observation_dictionary[varargs_name] = args[len(arginfo.args):]
             for key, val in kwargs.iteritems():
                 observation_dictionary[key] = val
-            observation_dictionary = {key: val for (key, val) in observation_dictionary.iteritems()
-                                      if key not in excluded_keys}
+            return {key: val for (key, val) in observation_dictionary.iteritems()
+                    if key not in excluded_keys}
+
+        def project_observation(argument_dictionary):
+            # Apply include_keys and formatters to the arguments, without changing them
+            if observed_keys is None and not value_formatters:
+                return argument_dictionary
+            if observed_keys is not None:
+                observation_dictionary = {key: val for (key, val) in argument_dictionary.iteritems()
+                                          if key in observed_keys}
+            else:
+                observation_dictionary = dict(argument_dictionary)
+            for key, formatter in value_formatters:
+                if key in observation_dictionary:
+                    observation_dictionary[key] = formatter(observation_dictionary[key])
+            return observation_dictionary
+
+        def make_observation_dictionary(args, kwargs):
+            return project_observation(make_argument_dictionary(args, kwargs))
+
+        def record_call(recorder, args, kwargs):
+            # Record the call in the flight recorder, outside of tests
+            spy_point_name_local = spy_point_name_for_call(args)
+            recorder.record(spy_point_name_local, make_observation_dictionary(args, kwargs))
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                recorder.record(spy_point_name_local, e, kind='exception')
+                raise
+
+        fn_source_hash = []  # Computed on first use, when memoizing
+
+        def invoke_fn(the_bond, spy_point_name_local, args, kwargs):
+            profiler = the_bond.profiler
+            if profiler is None:
+                return fn(*args, **kwargs)
+            start_time = bond_profile.timer()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.record_run(spy_point_name_local, bond_profile.timer() - start_time)
+
+        def spy_and_call(the_bond, spy_point_name_local, args, kwargs, rejected_agents):
+            # Spy the call, and then invoke the function, unless an agent provides the result
+            # The cassettes and the memoization are keyed on all the arguments, not on the observation
+            argument_dictionary = make_argument_dictionary(args, kwargs)
+            observation_dictionary = project_observation(argument_dictionary)
 
-            response = the_bond.spy(spy_point_name=spy_point_name_local,
-                                    skip_save_observation=mock_only,
-                                    **observation_dictionary)
+            response = the_bond._spy(spy_point_name_local, mock_only, observation_dictionary,
+                                     rejected_agents=rejected_agents)
             if require_agent_result:
+                if response is AGENT_RESULT_NONE:
+                    response = the_bond.play_cassette(spy_point_name_local, argument_dictionary,
+                                                      lambda: invoke_fn(the_bond, spy_point_name_local,
+                                                                        args, kwargs))
                 assert response is not AGENT_RESULT_NONE, \
                     'You MUST mock out spy_point {}: {}'.format(spy_point_name_local,
                                                                 repr(observation_dictionary))
             if response is AGENT_RESULT_NONE or response is AGENT_RESULT_CONTINUE:
-                return_val = fn(*args, **kwargs)
+                if memoize:
+                    if not fn_source_hash:
+                        fn_source_hash.append(bond_memoize.source_hash(fn))
+                    return_val = the_bond.memoized_call(spy_point_name_local, fn_source_hash[0],
+                                                        argument_dictionary,
+                                                        lambda: invoke_fn(the_bond, spy_point_name_local,
+                                                                          args, kwargs))
+                else:
+                    return_val = invoke_fn(the_bond, spy_point_name_local, args, kwargs)
             else:
                 return_val = response
 
@@ -366,18 +712,312 @@ def spy_point(spy_point_name=None,
                 the_bond.spy(spy_point_name_local + '.result', result=return_val)
             return return_val
 
+        @wraps(fn)
+        def fn_wrapper(*args, **kwargs):
+            # Bypass spying if we are not TESTING
+            if not active():
+                recorder = bond_flight_recorder.recorder
+                if (recorder is None or mock_only or
+                        not recorder.enabled_for_groups(enabled_for_groups_local) or
+                        (when is not None and not when(*args, **kwargs))):
+                    return fn(*args, **kwargs)
+                return record_call(recorder, args, kwargs)
+            if when is not None and not require_agent_result and not when(*args, **kwargs):
+                return fn(*args, **kwargs)
+            the_bond = Bond.instance()
+            if enabled_for_groups_local is not None:
+                for grp in enabled_for_groups_local:
+                    if grp in the_bond.spy_groups:
+                        break
+                else:
+                    # We are only enabled for some groups, but none of those and active
+                    return fn(*args, **kwargs)
+
+            spy_point_name_local = spy_point_name_for_call(args)
+            rejected_agents = ()
+            guarded_agents = the_bond.spy_guards.get(spy_point_name_local) if the_bond.spy_guards else None
+            if guarded_agents:
+                # An agent whose guard rejects the call does not apply to it
+                rejected_agents = [agent for agent in guarded_agents if not agent.when_spec(*args, **kwargs)]
+                if (when is None and not require_agent_result and
+                        len(rejected_agents) == len(the_bond.spy_agents[spy_point_name_local])):
+                    # No agent may apply, and the spy point did not ask for this call
+                    return fn(*args, **kwargs)
+
+            tracer = the_bond.tracer
+            if tracer is None:
+                return spy_and_call(the_bond, spy_point_name_local, args, kwargs, rejected_agents)
+            tracer.begin(spy_point_name_local)
+            try:
+                return spy_and_call(the_bond, spy_point_name_local, args, kwargs, rejected_agents)
+            finally:
+                tracer.end(spy_point_name_local)
+
+        fn_wrapper._bond_spy_point = True  # So that spy_class leaves it alone
         return fn_wrapper
 
     return wrap
 
 
+def spy_class(include=None,
+              exclude=None,
+              groups=None,
+              **kwargs):
+    """
+    Class decorator that applies :py:func:`spy_point` to the methods of a class, including the static
+    methods and the class methods. The methods are wrapped once, when the class is created, with the
+    spy point names ``ClassName.method_name``, using the name of the decorated class also for the calls
+    on the instances of subclasses.
+
+    .. code::
+
+        @bond.spy_class(exclude=('ping',), groups='services')
+        class BusService(object):
+            def get_buses(self, route):
+                ...
+
+            @staticmethod
+            def parse(response):
+                ...
+
+    :param include: (optional) a list or tuple of the names of the methods to spy, which must be defined in
+                    the class. By default, all the methods defined in the class whose name does not start
+                    with '_'.
+    :param exclude: (optional) a list or tuple of the names of the methods not to spy
+    :param groups: (optional) the spy point groups of the methods, as ``enabled_for_groups``
+                   for :py:func:`spy_point`
+    :param kwargs: (optional) other arguments for :py:func:`spy_point`, for all the methods.
+                   The ``excluded_keys`` default to ``('self', 'cls')``.
+                   The methods that are already decorated with :py:func:`spy_point` are left as they are.
+    """
+    spy_point_kwargs = dict(kwargs)
+    spy_point_kwargs.setdefault('excluded_keys', ('self', 'cls'))
+    assert 'spy_point_name' not in spy_point_kwargs, 'spy_class names the spy points after the methods'
+
+    def wrap(cls):
+        if include is not None:
+            for name in include:
+                assert name in cls.__dict__, 'Method {} is not defined in class {}'.format(name, cls.__name__)
+        for name, member in cls.__dict__.items():
+            if include is not None:
+                if name not in include:
+                    continue
+            elif name.startswith('_'):
+                continue
+            if exclude is not None and name in exclude:
+                continue
+            # The binder re-creates the method descriptor around the spy point
+            if isinstance(member, staticmethod):
+                fn, binder = member.__func__, staticmethod
+            elif isinstance(member, classmethod):
+                fn, binder = member.__func__, classmethod
+            elif inspect.isfunction(member):
+                fn, binder = member, None
+            else:
+                continue
+            if getattr(fn, '_bond_spy_point', False):
+                continue
+            wrapped = spy_point(spy_point_name=cls.__name__ + '.' + name,
+                                enabled_for_groups=groups,
+                                **spy_point_kwargs)(fn)
+            setattr(cls, name, binder(wrapped) if binder is not None else wrapped)
+        return cls
+
+    return wrap
+
+
+def start_flight_recorder(capacity=1000,
+                          spy_groups=None,
+                          dump_file=None,
+                          dump_on_signal=None,
+                          dump_on_exception=False):
+    """
+    Start the flight recorder, for use in production code. While no test is active, the
+    enabled spy points and the calls to :py:func:`spy` record compact observations into a bounded
+    in-memory ring buffer, with the most recent invocations. The buffer can be dumped
+    with :py:func:`dump_flight_recorder`, to get a post-mortem history of the calls.
+
+    .. code::
+
+        bond.start_flight_recorder(capacity=10000, dump_on_signal=signal.SIGUSR1)
+
+    Each invocation keeps a compact snapshot of its arguments, taken at the time of the call: the
+    scalars, and the truncated repr of the other values. Spy points with ``mock_only`` are not recorded.
+
+    :param capacity: (optional) the maximum number of invocations to keep. Defaults to 1000.
+    :param spy_groups: (optional) the list, or tuple, of spy point groups that are enabled, as
+                       for :py:func:`start_test`.
+    :param dump_file: (optional) the file where to dump the buffer. Defaults to
+                      ``/tmp/bond_flight_recorder_<pid>.json``.
+    :param dump_on_signal: (optional) a signal number, e.g., ``signal.SIGUSR1``, on which to dump the buffer.
+    :param dump_on_exception: (optional) if True, then dump the buffer when the process exits
+                              due to an uncaught exception.
+    """
+    stop_flight_recorder()
+    recorder = bond_flight_recorder.FlightRecorder(capacity=capacity,
+                                                   spy_groups=spy_groups,
+                                                   dump_file=dump_file)
+    if dump_on_signal is not None:
+        recorder.install_signal_handler(dump_on_signal)
+    if dump_on_exception:
+        recorder.install_excepthook()
+    bond_flight_recorder.recorder = recorder
+
+
+def stop_flight_recorder():
+    """
+    Stop the flight recorder, and discard its buffer.
+    """
+    recorder = bond_flight_recorder.recorder
+    if recorder is not None:
+        bond_flight_recorder.recorder = None
+        recorder.uninstall()
+
+
+def dump_flight_recorder(dump_file=None):
+    """
+    Dump the buffer of the flight recorder, one JSON record per line, oldest first.
+
+    :param dump_file: (optional) the file where to dump the buffer. Defaults to the one given
+                      to :py:func:`start_flight_recorder`.
+    :return: the name of the file, or None if the flight recorder is not started.
+    """
+    recorder = bond_flight_recorder.recorder
+    if recorder is None:
+        return None
+    return recorder.dump(dump_file)
+
+
+# The settings that determine where the reference observations are, so that we prefetch
+# the reference again when they change during a test
+_PREFETCH_SETTINGS = ('observation_directory', 'observation_store', 'prefetch')
+
+# The separators for the observations kept in memory. These are the separators that
+# json.dumps uses with indent, so that the normalizers see the same text in both cases.
+_OBSERVATION_SEPARATORS = (', ', ': ')
+
+
+class _ObservationEncoder(json.JSONEncoder):
+    """
+    A JSON encoder that formats the floats with a number of decimals. The json module formats the
+    floats with a global function, which the concurrent Bond sessions, with their own precisions,
+    cannot share.
+    """
+
+    def __init__(self, decimal_precision, **kwargs):
+        json.JSONEncoder.__init__(self, **kwargs)
+        self.float_format = '.{}f'.format(decimal_precision)
+
+    def iterencode(self, o, _one_shot=False):
+        # As json.JSONEncoder.iterencode does with sort_keys, for which it does not use the C encoder
+        float_format = self.float_format
+
+        def floatstr(o):
+            if o != o:
+                return 'NaN'
+            if o == encoder.INFINITY:
+                return 'Infinity'
+            if o == -encoder.INFINITY:
+                return '-Infinity'
+            return format(o, float_format)
+
+        iterencode = encoder._make_iterencode({} if self.check_circular else None,
+                                              self.default,
+                                              (encoder.encode_basestring_ascii if self.ensure_ascii
+                                               else encoder.encode_basestring),
+                                              self.indent, floatstr,
+                                              self.key_separator, self.item_separator, self.sort_keys,
+                                              self.skipkeys, _one_shot)
+        return iterencode(o, 0)
+
+
+# The tokens of an observation serialized on one line, which determine the indentation:
+# strings (skipped), opening brackets (possibly with the closing bracket of an empty container),
+# closing brackets and item separators
+_OBSERVATION_TOKEN_RE = re.compile(r'("(?:[^"\\]|\\.)*")|([\[{])([\]}])?|([\]}])|(, )')
+
+
+def _indent_observation(observation, indent=4):
+    """
+    Indent an observation serialized on one line, exactly as json.dumps(indent=4) would
+    """
+    level = [0]
+
+    def replace(m):
+        json_string, open_bracket, empty_close_bracket, close_bracket, _ = m.groups()
+        if json_string is not None:
+            return json_string
+        if open_bracket is not None:
+            if empty_close_bracket is not None:
+                return open_bracket + empty_close_bracket
+            level[0] += 1
+            return open_bracket + '\n' + ' ' * (indent * level[0])
+        if close_bracket is not None:
+            level[0] -= 1
+            return '\n' + ' ' * (indent * level[0]) + close_bracket
+        return ', \n' + ' ' * (indent * level[0])
+
+    return _OBSERVATION_TOKEN_RE.sub(replace, observation)
+
+
+def _observation_strings(observations, observation_repeats):
+    """
+    Generate the observations, each serialized on one line, with the number of repeats
+    :param observation_repeats: a map from the index of a collapsed observation to its number of occurrences
+    """
+    for idx, observation in enumerate(observations):
+        repeats = observation_repeats.get(idx)
+        if repeats is not None:
+            observation = _add_repeat_count(observation, repeats)
+        yield observation
+
+
+def _observation_lines(observations, observation_repeats):
+    """
+    :return: the lines of the observation file for the observations
+    """
+    lines = ['[\n']
+    last_idx = len(observations) - 1
+    for idx, observation in enumerate(_observation_strings(observations, observation_repeats)):
+        formatted = bond_table.compact_tables(_indent_observation(observation))
+        if idx < last_idx:
+            formatted += ','
+        lines.extend(line + '\n' for line in formatted.split('\n'))
+    lines.append(']\n')
+    return lines
+
+
+def _add_repeat_count(observation, repeats):
+    """
+    Add the __repeat__ key to an observation serialized on one line. The key
+    comes first, as the keys are sorted.
+    """
+    assert observation.startswith('{')
+    if observation == '{}':
+        return '{{"__repeat__": {}}}'.format(repeats)
+    return '{{"__repeat__": {}, {}'.format(repeats, observation[1:])
+
+
 class Bond:
+    """
+    A Bond session: the state of the Bond test that is running. There is a global session, and each
+    thread may bind its own session, with :py:func:`bind_session`, to run tests concurrently.
+    """
     DEFAULT_OBSERVATION_DIRECTORY = '/tmp/bond_observations'
 
     _instance = None
 
+    # The sessions bound to threads
+    _bound = threading.local()
+
     @staticmethod
     def instance():
+        """
+        The session for the current thread: the one bound to the thread, if any, or else the global session
+        """
+        session = getattr(Bond._bound, 'session', None)
+        if session is not None:
+            return session
         if Bond._instance is None:
             Bond._instance = Bond()
         return Bond._instance
@@ -391,7 +1031,14 @@ class Bond:
         self.test_name = None
         self.spy_groups = None  # Map indexed on enabled spy groups
         self.observations = []  # Here we will collect the observations
+        self.observation_repeats = {}  # Map from the index of a collapsed observation to its number of occurrences
+        self.last_observation = None  # The last observation before formatting, if we may collapse repeats of it
         self.spy_agents = {}  # Map from spy_point_name to SpyAgents
+        self.spy_guards = {}  # Map from spy_point_name to its agents with when guards
+        self.profiler = None  # A SpyProfiler, if we are profiling
+        self.tracer = None  # A SpyTracer, if we are tracing
+        self.cassette = None  # A Cassette, created on first use
+        self.normalizer = None  # A Normalizer, if there are normalizers
 
     def settings(self, **kwargs):
         """
@@ -402,9 +1049,30 @@ class Bond:
         """
         # Get the not-None keys
         for k, v in kwargs.iteritems():
-            self._settings[k] = v
+            if v is not None:
+                self._settings[k] = v
         if 'spy_groups' in self._settings:
             self._set_spy_groups(self._settings['spy_groups'])
+        if self._settings.get('profile'):
+            if self.profiler is None:
+                self.profiler = bond_profile.SpyProfiler()
+        else:
+            self.profiler = None
+        if self._settings.get('trace'):
+            if self.tracer is None:
+                self.tracer = bond_profile.SpyTracer()
+        else:
+            self.tracer = None
+        normalizers = self._settings.get('normalizers')
+        if normalizers:
+            if self.normalizer is None or self.normalizer.rules is not normalizers:
+                self.normalizer = bond_normalize.Normalizer(normalizers)
+        else:
+            self.normalizer = None
+        if self.active() and self.test_name is not None and any(kwargs.get(k) is not None
+                                                                for k in _PREFETCH_SETTINGS):
+            # The reference may be elsewhere now
+            self._prefetch_reference()
 
     def start_test(self,
                    current_python_test,
@@ -417,35 +1085,80 @@ class Bond:
         """
 
         self.observations = []
+        self.observation_repeats = {}
+        self.last_observation = None
         self.spy_agents = {}
+        self.spy_guards = {}
         self.spy_groups = {}
+        self.profiler = None
+        self.tracer = None
+        self.cassette = None
+        self.normalizer = None
+        self.test_name = None
         self.test_framework_bridge = TestFrameworkBridge.make_bridge(current_python_test)
 
-        self._settings = {}  # Clear settings before each test
+        # Clear settings before each test. We keep the settings that start_test leaves as None, unlike
+        # settings, so that we can tell which ones were passed
+        self._settings = dict(kwargs)
         self.settings(**kwargs)
 
         self.test_name = (self._settings.get('test_name') or
                           self.test_framework_bridge.full_test_name())
 
-        if self._settings['decimal_precision'] is None:
+        if self._settings.get('decimal_precision') is None:
             self._settings['decimal_precision'] = 4
 
+        if self._settings.get('cassette') is None and os.environ.get('BOND_CASSETTE'):
+            self._settings['cassette'] = os.environ.get('BOND_CASSETTE')
+
+        if self._settings.get('observation_store') is None and os.environ.get('BOND_OBSERVATION_STORE'):
+            self._settings['observation_store'] = os.environ.get('BOND_OBSERVATION_STORE')
+
+        if self._settings.get('compress_threshold') is None and os.environ.get('BOND_COMPRESS_THRESHOLD'):
+            self._settings['compress_threshold'] = int(os.environ.get('BOND_COMPRESS_THRESHOLD'))
+
+        if self._settings.get('prefetch') is None and os.environ.get('BOND_PREFETCH'):
+            self._settings['prefetch'] = os.environ.get('BOND_PREFETCH') == '1'
+
+        if self._settings.get('write_behind') is None and os.environ.get('BOND_WRITE_BEHIND'):
+            self._settings['write_behind'] = os.environ.get('BOND_WRITE_BEHIND') == '1'
+
         # Register us on test exit
         self.test_framework_bridge.on_finish_test(self._finish_test)
 
         if 'observation_directory' not in self._settings:
             print('WARNING: you should set the settings(observation_directory). Observations saved to {}'.format(
-                Bond.DEFAULT_OBSERVATION_DIRECTORY
+                self._observation_directory()
             ))
 
+        self._prefetch_reference()
+
     def active(self):
         return (self.test_framework_bridge is not None)
 
     def spy(self, spy_point_name=None, skip_save_observation=False, **kwargs):
+        return self._spy(spy_point_name, skip_save_observation, kwargs)
+
+    def _spy(self, spy_point_name, skip_save_observation, kwargs, rejected_agents=()):
+        """
+        Spy an observation
+        :param kwargs: the dictionary with the observation, which is copied
+        :param rejected_agents: the agents that do not apply, because their when guards rejected the call
+        """
         if not self.test_framework_bridge:
-            # Don't do anything if we are not testing
+            # Don't do anything if we are not testing, except for the flight recorder
+            recorder = bond_flight_recorder.recorder
+            if recorder is not None and not skip_save_observation:
+                recorder.record(spy_point_name, kwargs)
             return None
 
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.record_spy(spy_point_name if spy_point_name is not None else '<unnamed>')
+            start_time = bond_profile.timer()
+        if self.tracer is not None:
+            self.tracer.instant(spy_point_name if spy_point_name is not None else '<unnamed>')
+
         if spy_point_name is not None:
             assert isinstance(spy_point_name, basestring), "spy_point_name must be a string"
 
@@ -453,21 +1166,48 @@ class Bond:
             active_agent = None
 
             for agent in self.spy_agents.get(spy_point_name, []):
-                if not agent.filter(kwargs):
+                if not agent.filter(kwargs) or (rejected_agents and agent in rejected_agents):
                     continue
                 active_agent = agent
                 break
         else:
             active_agent = None
 
+        if profiler is not None:
+            end_time = bond_profile.timer()
+            profiler.record_overhead('agents', end_time - start_time)
+            start_time = end_time
+
         observation = copy.deepcopy(kwargs)
         if spy_point_name is not None:
             observation['__spy_point__'] = spy_point_name  # Use a key that should come first alphabetically
 
+        if profiler is not None:
+            profiler.record_overhead('deepcopy', bond_profile.timer() - start_time)
+
         def save_observation():
+            collapse_repeats = self._settings.get('collapse_repeats')
+            if active_agent is not None and active_agent.collapse_repeats is not None:
+                collapse_repeats = active_agent.collapse_repeats
+            if collapse_repeats and self.last_observation == observation:
+                # Count the repeat, without formatting the observation again
+                last_idx = len(self.observations) - 1
+                self.observation_repeats[last_idx] = self.observation_repeats.get(last_idx, 1) + 1
+                return
+            if collapse_repeats:
+                # The formatter may change the observation in place
+                self.last_observation = (copy.deepcopy(observation) if active_agent is not None
+                                         else observation)
+            else:
+                self.last_observation = None
+
             # We postpone applying the formatter until we have run the "doer" and the "result"
+            if profiler is not None:
+                format_start_time = bond_profile.timer()
             formatted = self._format_observation(observation,
                                                  active_agent=active_agent)
+            if profiler is not None:
+                profiler.record_overhead('format', bond_profile.timer() - format_start_time)
             # print("Observing: " + formatted + "\n")
             # TODO ETK
             self.observations.append(formatted)
@@ -494,6 +1234,150 @@ class Bond:
 
         return AGENT_RESULT_NONE
 
+    def spy_table(self, spy_point_name, rows, columns=None, sort_key=None, **kwargs):
+        """
+        Spy a table.
+        See documentation for the top-level spy_table function.
+        """
+        if not self.test_framework_bridge and bond_flight_recorder.recorder is None:
+            return None
+        kwargs[bond_table.TABLE_KEY] = bond_table.make_table(rows, columns=columns, sort_key=sort_key)
+        return self.spy(spy_point_name, **kwargs)
+
+    def spy_many(self, spy_point_name, rows):
+        """
+        Record a batch of observations.
+        See documentation for the top-level spy_many function.
+        """
+        if not self.test_framework_bridge:
+            for row in rows:
+                self.spy(spy_point_name, **row)
+            return None
+        rows = list(rows)
+
+        profiler = self.profiler
+        if profiler is not None:
+            start_time = bond_profile.timer()
+
+        if spy_point_name is not None:
+            assert isinstance(spy_point_name, basestring), "spy_point_name must be a string"
+            agents = self.spy_agents.get(spy_point_name)
+            if agents and any(agent.filter(row) for row in rows for agent in agents):
+                # The agents may change the observations, or spy, so we process the rows one by one.
+                # Each of them is profiled and traced by spy
+                return [self.spy(spy_point_name, **row) for row in rows]
+
+        profile_name = spy_point_name if spy_point_name is not None else '<unnamed>'
+        if profiler is not None:
+            profiler.record_overhead('agents', bond_profile.timer() - start_time)
+            for _ in rows:
+                profiler.record_spy(profile_name)
+            start_time = bond_profile.timer()
+        if self.tracer is not None:
+            for _ in rows:
+                self.tracer.instant(profile_name)
+
+        observations = copy.deepcopy(rows)
+        if spy_point_name is not None:
+            for observation in observations:
+                observation['__spy_point__'] = spy_point_name
+
+        if profiler is not None:
+            end_time = bond_profile.timer()
+            profiler.record_overhead('deepcopy', end_time - start_time)
+            start_time = end_time
+
+        # Collapse the repeats before formatting, as in spy
+        collapse_repeats = self._settings.get('collapse_repeats')
+        to_format = []  # The observations to format, in order
+        repeats = []  # The number of occurrences for each of them
+        last_observation = self.last_observation
+        for observation in observations:
+            if collapse_repeats and last_observation == observation:
+                if repeats:
+                    repeats[-1] += 1
+                else:
+                    last_idx = len(self.observations) - 1
+                    self.observation_repeats[last_idx] = self.observation_repeats.get(last_idx, 1) + 1
+                continue
+            to_format.append(observation)
+            repeats.append(1)
+            last_observation = observation
+        self.last_observation = last_observation if collapse_repeats else None
+
+        for formatted, count in zip(self._format_observations(to_format), repeats):
+            self.observations.append(formatted)
+            if count > 1:
+                self.observation_repeats[len(self.observations) - 1] = count
+
+        if profiler is not None:
+            profiler.record_overhead('format', bond_profile.timer() - start_time)
+        return [AGENT_RESULT_NONE] * len(rows)
+
+    def begin_unordered(self):
+        """
+        Start a region of unordered observations.
+        See documentation for the top-level unordered function.
+        :return: the position of the region in the observations, or None if not testing
+        """
+        if not self.test_framework_bridge:
+            return None
+        return len(self.observations)
+
+    def end_unordered(self, start):
+        """
+        End a region of unordered observations, by sorting its observations
+        :param start: the result of the corresponding begin_unordered
+        """
+        if start is None or not self.test_framework_bridge:
+            return
+        region = self.observations[start:]
+        for idx in range(start, len(self.observations)):
+            repeats = self.observation_repeats.pop(idx, None)
+            if repeats is not None:
+                region[idx - start] = _add_repeat_count(region[idx - start], repeats)
+        # The observations are serialized with sorted keys, so sorting the
+        # serialized observations gives a canonical order
+        region.sort()
+        self.observations[start:] = region
+        self.last_observation = None
+
+    def play_cassette(self, spy_point_name, argument_dictionary, invoke):
+        """
+        Compute the result of a call to a spy point that requires an agent result, when no agent
+        provides one, using the cassette, if enabled.
+        :param argument_dictionary: the arguments of the call, which identify it in the cassette
+        :param invoke: a function to invoke the real function, when recording
+        :return: the result, or AGENT_RESULT_NONE if there is no cassette or the call was not recorded
+        """
+        mode = self._settings.get('cassette')
+        if not mode:
+            return AGENT_RESULT_NONE
+        if self.cassette is None:
+            self.cassette = bond_cassette.Cassette(self._observation_file_name() + '.cassette.json', mode)
+
+        observation = dict(argument_dictionary)
+        observation['__spy_point__'] = spy_point_name
+        key = self._canonical_observation(observation)
+        if self.cassette.mode == bond_cassette.REPLAY:
+            found, result = self.cassette.replay(key)
+            return result if found else AGENT_RESULT_NONE
+        return self.cassette.record(key, invoke())
+
+    def memoized_call(self, spy_point_name, fn_source_hash, argument_dictionary, invoke):
+        """
+        Return the memoized result of a call to a spy point with memoize=True
+        :param argument_dictionary: the arguments of the call, which are part of the memoization key
+        :param invoke: a function to invoke the real function, on a cache miss
+        """
+        key = bond_memoize.memo_key(spy_point_name, fn_source_hash, argument_dictionary,
+                                    self._custom_json_serializer)
+        if self._settings.get('memoize_on_disk'):
+            disk_directory = os.path.join(self._observation_directory(), bond_memoize.DISK_STORE_DIRECTORY)
+        else:
+            disk_directory = None
+        return bond_memoize.memoized_call(key, invoke, disk_directory=disk_directory)
+
     def deploy_agent(self, spy_point_name, **kwargs):
         """
         Deploy an agent for a spy point.
@@ -512,6 +1396,8 @@ class Bond:
             self.spy_agents[spy_point_name] = spy_agent_list
         # add the agent at the start of the list
         spy_agent_list.insert(0, agent)
+        if agent.when_spec is not None:
+            self.spy_guards.setdefault(spy_point_name, []).append(agent)
 
     def _set_spy_groups(self, spy_groups):
         self.spy_groups = {}
@@ -532,15 +1418,41 @@ class Bond:
         if active_agent:
             active_agent.formatter(observation)
 
-        original_float_repr = encoder.FLOAT_REPR
-        format_string = '.{}f'.format(self._settings['decimal_precision'])
-        encoder.FLOAT_REPR = lambda o: format(o, format_string)
-        ret = json.dumps(observation,
-                         sort_keys=True,
-                         indent=4,
-                         default=self._custom_json_serializer)
-        encoder.FLOAT_REPR = original_float_repr
-        return ret
+        # We keep the observations in memory on one line, and we indent them only when
+        # we write them out, in _get_observations
+        normalizer = self.normalizer
+        if normalizer is None:
+            return self._json_dumps(observation, separators=_OBSERVATION_SEPARATORS)
+        return normalizer.normalize(self._json_dumps(observation, separators=_OBSERVATION_SEPARATORS,
+                                                     default=normalizer.serializer(self._custom_json_serializer)))
+
+    def _format_observations(self, observations):
+        """
+        Format a batch of observations, without agents, with one encoder, as _format_observation does
+        """
+        normalizer = self.normalizer
+        json_encoder = _ObservationEncoder(self._settings['decimal_precision'],
+                                           sort_keys=True,
+                                           separators=_OBSERVATION_SEPARATORS,
+                                           default=(normalizer.serializer(self._custom_json_serializer)
+                                                    if normalizer is not None else self._custom_json_serializer))
+        if normalizer is None:
+            return [json_encoder.encode(observation) for observation in observations]
+        return [normalizer.normalize(json_encoder.encode(observation)) for observation in observations]
+
+    def _canonical_observation(self, observation):
+        """
+        The observation serialized on one line, with sorted keys
+        """
+        return self._json_dumps(observation, separators=(',', ':'))
+
+    def _json_dumps(self, obj, **kwargs):
+        kwargs.setdefault('default', self._custom_json_serializer)
+        return json.dumps(obj,
+                          cls=_ObservationEncoder,
+                          decimal_precision=self._settings['decimal_precision'],
+                          sort_keys=True,
+                          **kwargs)
 
     def _custom_json_serializer(self, obj):
         # TODO: figure out how to do this. Must be customizable from settings
@@ -569,15 +1481,31 @@ class Bond:
                 no_save = None
 
             fname = self._observation_file_name()
-            fdir = os.path.dirname(fname)
-            if not os.path.isdir(fdir):
-                os.makedirs(fdir)
+            reconciler = ObservationReconciler(self.test_name, self.observations, self.observation_repeats,
+                                               self._store_settings(),
+                                               reconcile=self._settings.get('reconcile'),
+                                               no_save=no_save)
 
-            reference_file = fname + '.json'
-            current_lines = self._get_observations()
+            if self.cassette is not None:
+                self.cassette.save()
 
             # We have to reconcile them
-            reconcile_res = self._reconcile_observations(reference_file, current_lines, no_save=no_save)
+            bridge = self.test_framework_bridge
+            if self._write_behind():
+                # The result is reported at the end of the session
+                bond_background.finisher().submit(self.test_name, lambda: bridge.reconcile(reconciler))
+                reconcile_res = True
+            else:
+                reconcile_res = bridge.reconcile(reconciler)
+
+            if self.tracer is not None:
+                fdir = os.path.dirname(fname)
+                if not os.path.isdir(fdir):
+                    os.makedirs(fdir)
+                self.tracer.save(fname + '.trace.json')
+            if self.profiler is not None:
+                print(self.profiler.report(self.test_name))
+                bond_profile.merge_into_session(self.profiler)
 
             if not test_failed:
                 # If the test did not fail already, but it failed reconcile, fail the test
@@ -592,6 +1520,24 @@ class Bond:
                               self.test_name.split('.'))
         return fname
 
+    def _reference_store(self):
+        return bond_store.reference_store(**self._store_settings())
+
+    def _store_settings(self):
+        """
+        :return: the arguments of :py:func:`bond_store.reference_store` for the store of the current test
+        """
+        return dict(kind=self._settings.get('observation_store') or bond_store.FILES,
+                    observation_directory=self._observation_directory(),
+                    compress_threshold=self._settings.get('compress_threshold'))
+
+    def _prefetch_reference(self):
+        """
+        Start reading the reference observations in the background, if enabled
+        """
+        if self._settings.get('prefetch'):
+            self._reference_store().prefetch(self.test_name)
+
     def _observation_directory(self):
         obs_dir = self._settings.get('observation_directory')
         if obs_dir is not None:
@@ -611,21 +1557,89 @@ class Bond:
         Return all of the observations as a list of lines that would be
         printed out
         """
-        if len(self.observations) == 0:
-            return ['[\n', ']\n']
-        else:
-            return ['[\n'] + [line + '\n' for line in string.split(',\n'.join(self.observations), '\n')] + [']\n']
-
-    def _reconcile_observations(self,
-                                reference_file,
-                                current_lines,
-                                no_save=None):
-        settings = dict(reconcile=self._settings.get('reconcile'))
-        return bond_reconcile.reconcile_observations(settings,
+        return _observation_lines(self.observations, self.observation_repeats)
+
+    def _write_behind(self):
+        """
+        Whether to finish the current test in the background. Only for the reconcile methods
+        that do not interact with the user.
+        """
+        if not self._settings.get('write_behind'):
+            return False
+        reconcile = self._settings.get('reconcile') or os.environ.get('BOND_RECONCILE', 'console')
+        return reconcile in ('accept', 'abort')
+
+
+class ObservationReconciler:
+    """
+    Reconciles the observations of a test with the reference observations. It keeps a snapshot of what
+    it needs from the test, so that it can run after the next test started, or in another process.
+    """
+
+    def __init__(self, test_name, observations, observation_repeats, store_settings, reconcile=None, no_save=None):
+        """
+        :param observations: the observations, each serialized on one line, or None if the lines are given later
+        :param observation_repeats: the map from the index of a collapsed observation to its number of occurrences
+        :param store_settings: the arguments of :py:func:`bond_store.reference_store` for the reference store
+        :param reconcile: the reconcile method
+        :param no_save: if not None, the reason why the reference may not be saved
+        """
+        self.test_name = test_name
+        self.observations = observations
+        self.observation_repeats = observation_repeats
+        self.store_settings = store_settings
+        self.reconcile = reconcile
+        self.no_save = no_save
+        self.current_lines = None  # The lines of the observation file, once formatted
+
+    def __call__(self):
+        """
+        Reconcile the observations
+        :return: True if they are the same as the reference, or were accepted
+        """
+        store = bond_store.reference_store(**self.store_settings)
+        return bond_reconcile.reconcile_observations(dict(reconcile=self.reconcile),
                                                      test_name=self.test_name,
-                                                     reference_file=reference_file,
-                                                     current_lines=current_lines,
-                                                     no_save=no_save)
+                                                     reference_file=store.location(self.test_name),
+                                                     current_lines=self.lines(),
+                                                     no_save=self.no_save,
+                                                     store=store)
+
+    def lines(self):
+        """
+        :return: the lines of the observation file for the observations
+        """
+        if self.current_lines is None:
+            self.current_lines = _observation_lines(self.observations, self.observation_repeats)
+        return self.current_lines
+
+    def matches(self):
+        """
+        :return: True if the observations are the same as the reference, without reconciling them
+        """
+        store = bond_store.reference_store(**self.store_settings)
+        return store.matches(self.test_name, self.lines())
+
+    def to_json(self):
+        """
+        :return: the reconciler as simple values, to be sent to another process
+        """
+        return dict(test_name=self.test_name,
+                    current_lines=self.lines(),
+                    store_settings=self.store_settings,
+                    reconcile=self.reconcile,
+                    no_save=self.no_save)
+
+    @staticmethod
+    def from_json(value):
+        """
+        :return: the reconciler sent from another process, in the form returned by :py:meth:`to_json`
+        """
+        reconciler = ObservationReconciler(value['test_name'], None, None, dict(value['store_settings']),
+                                           reconcile=value['reconcile'],
+                                           no_save=value['no_save'])
+        reconciler.current_lines = list(value['current_lines'])
+        return reconciler
 
 
 class SpyAgent:
@@ -645,6 +1659,8 @@ class SpyAgent:
         self.point_filter = None  # The filter for pointName, if present
         self.filters = []  # The generic filters
         self.skip_save_observation = None
+        self.collapse_repeats = None
+        self.when_spec = None  # The guard on the arguments of the calls of a spy point, if present
 
         for k in kwargs:
             if k == 'result':
@@ -661,6 +1677,10 @@ class SpyAgent:
                     self.doers.append(doers)
             elif k == 'skip_save_observation':
                 self.skip_save_observation = kwargs[k]
+            elif k == 'collapse_repeats':
+                self.collapse_repeats = kwargs[k]
+            elif k == 'when':
+                self.when_spec = kwargs[k]
             else:
                 # Must be a filter
                 fo = SpyAgentFilter(k, kwargs[k])
@@ -750,6 +1770,11 @@ class TestFrameworkBridge:
     """
     A class to abstract the interface to the host test framework
     """
+
+    # A static method that makes the bridge for a test, or returns None to use the default bridges.
+    # This is set by the plugins for test frameworks, e.g., :py:mod:`bond.pytest_plugin`
+    bridge_factory = None
+
     def __init__(self,
                  current_python_test):
         self.current_python_test = current_python_test
@@ -762,6 +1787,14 @@ class TestFrameworkBridge:
         :return:
         """
 
+        if isinstance(current_python_test, TestFrameworkBridge):
+            return current_python_test
+
+        if TestFrameworkBridge.bridge_factory is not None:
+            bridge = TestFrameworkBridge.bridge_factory(current_python_test)
+            if bridge is not None:
+                return bridge
+
         # We test for the presence of fields
         if hasattr(current_python_test, '_resultForDoCleanups'):
             resultForDoCleanups = current_python_test._resultForDoCleanups
@@ -801,6 +1834,15 @@ class TestFrameworkBridge:
         """
         assert False, "Must override"
 
+    def reconcile(self, reconciler):
+        """
+        Reconcile the observations of the test that ends. The frameworks may do this elsewhere,
+        e.g., in another process.
+        :param reconciler: an :py:class:`ObservationReconciler`
+        :return: False if the test must fail because of differences in the observations
+        """
+        return reconciler()
+
 
 class TestFrameworkBridgeUnittest(TestFrameworkBridge):
     """
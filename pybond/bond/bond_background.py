@@ -0,0 +1,126 @@
+"""
+Finishing the tests in the background (write-behind).
+
+When a test ends, its observations are handed to a worker thread, which formats them, compares
+them with the reference, and saves them, while the next test runs. This is only for the reconcile
+methods that do not interact with the user (``accept`` and ``abort``).
+
+The results are joined at the end of the session, with :py:func:`finish_session`, which fails
+with the list of the tests whose observations differ from the reference. The session must be
+finished explicitly (the pytest plugin does it) for the differences to fail the test run. Otherwise,
+the results are joined when the process exits, and the differences are only reported: the exit
+handlers cannot change the exit status without skipping the other exit handlers.
+"""
+
+from __future__ import print_function
+
+import atexit
+import sys
+import threading
+import traceback
+import Queue
+
+# Imported before we register our exit handler, so that the stores are flushed after the
+# tests finishing in the background wrote to them
+import bond_store
+
+
+class BackgroundFinisher:
+    """
+    A worker thread that finishes the tests in the order in which they ended
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.finished = 0  # The number of tests finished since the last join
+        self.mismatches = []  # The names of the tests whose observations differ, since the last join
+
+    def submit(self, test_name, finish):
+        """
+        Finish a test in the background
+        :param finish: a function that reconciles the observations of the test, and returns
+               True if they are the same as the reference
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='bond-finish')
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put((test_name, finish))
+
+    def join(self):
+        """
+        Wait for the tests submitted so far to finish
+        :return: the number of tests finished, and the list of the names of the tests whose observations
+                 differ from the reference, since the last join
+        """
+        self.queue.join()
+        with self.lock:
+            finished, mismatches = self.finished, self.mismatches
+            self.finished, self.mismatches = 0, []
+        return finished, mismatches
+
+    def stop(self):
+        """
+        Stop the worker thread, after it finished the tests submitted so far
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            test_name, finish = task
+            try:
+                matches = finish()
+            except Exception:
+                print('Error finishing the observations for {}:\n{}'.format(test_name, traceback.format_exc()))
+                matches = False
+            with self.lock:
+                self.finished += 1
+                if not matches:
+                    self.mismatches.append(test_name)
+            self.queue.task_done()
+
+
+_finisher = BackgroundFinisher()
+
+
+def finisher():
+    """
+    The worker that finishes the tests in the background
+    """
+    return _finisher
+
+
+def finish_session():
+    """
+    Wait for the tests finishing in the background, and fail if the observations of any
+    of them differ from the reference
+    :return: the number of tests that were finished in the background
+    """
+    finished, mismatches = _finisher.join()
+    assert not mismatches, 'Reconciling observations for {} test(s): {}'.format(len(mismatches),
+                                                                                ', '.join(mismatches))
+    return finished
+
+
+def _finish_at_exit():
+    if _finisher.thread is None:
+        return
+    finished, mismatches = _finisher.join()
+    _finisher.stop()
+    if mismatches:
+        print('Reconciling observations failed for {} test(s) finished in the background:\n  {}\n'
+              'The exit status does not reflect these failures. Call bond.finish_session() at the end of '
+              'the session, e.g., in tearDownModule.'.format(len(mismatches), '\n  '.join(mismatches)),
+              file=sys.stderr)
+
+atexit.register(_finish_at_exit)
@@ -0,0 +1,66 @@
+"""
+Record-and-replay cassettes for the spy points that require an agent result.
+
+In 'record' mode the real function is invoked and its result is stored in the cassette,
+keyed on the canonical observation of the call. In 'replay' mode the results are served
+from the cassette, as if an agent had provided them.
+"""
+
+import copy
+import json
+import os
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+
+class Cassette:
+    """
+    The results recorded for one test. For each canonical observation we keep the list
+    of results in the order of the calls, so that a sequence of calls with the same
+    arguments replays in order.
+    """
+
+    def __init__(self, cassette_file, mode):
+        assert mode in (RECORD, REPLAY), 'Unrecognized cassette mode: {}'.format(mode)
+        self.cassette_file = cassette_file
+        self.mode = mode
+        self.recordings = {}  # Map from the canonical observation to a list of results
+        self.replay_positions = {}  # Map from the canonical observation to the next result to replay
+        self.modified = False
+        if mode == REPLAY and os.path.isfile(cassette_file):
+            with open(cassette_file, 'r') as f:
+                self.recordings = json.load(f)
+
+    def replay(self, key):
+        """
+        Look up the next result for a call
+        :return: a pair of whether the result was found, and the result
+        """
+        results = self.recordings.get(key)
+        if not results:
+            return False, None
+        pos = self.replay_positions.get(key, 0)
+        # After we run out of results, we keep replaying the last one
+        self.replay_positions[key] = pos + 1
+        return True, copy.deepcopy(results[min(pos, len(results) - 1)])
+
+    def record(self, key, result):
+        """
+        Record the result of a call. The result must be JSON serializable.
+        :return: the result as it will be replayed, i.e., after a round trip through JSON
+        """
+        encoded = json.dumps(result)
+        self.recordings.setdefault(key, []).append(json.loads(encoded))
+        self.modified = True
+        return json.loads(encoded)
+
+    def save(self):
+        if self.mode != RECORD or not self.modified:
+            return
+        cassette_dir = os.path.dirname(self.cassette_file)
+        if cassette_dir and not os.path.isdir(cassette_dir):
+            os.makedirs(cassette_dir)
+        with open(self.cassette_file, 'w') as f:
+            json.dump(self.recordings, f, sort_keys=True, indent=4)
+        self.modified = False
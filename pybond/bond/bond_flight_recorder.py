@@ -0,0 +1,164 @@
+"""
+A flight recorder for production code: outside of tests, the enabled spy points record
+compact observations in a bounded in-memory ring buffer, which can be dumped on demand,
+on a signal, or when the process dies with an exception.
+"""
+
+from __future__ import print_function
+
+import collections
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+
+# The active FlightRecorder, or None. This is read by every spy point invoked outside of a test
+recorder = None
+
+
+class FlightRecorder:
+    """
+    A ring buffer of the most recent spy point invocations.
+
+    Each invocation is recorded as a compact snapshot of its observation, taken at the time of the
+    call: the scalars and the small tuples are kept, the strings are truncated to ``MAX_REPR_LENGTH``,
+    and the other values are replaced by their truncated repr. The memory for each slot is thus bounded, and the records show
+    the values at the time of the call even if they are mutated later. The buffer is a
+    ``collections.deque`` with a maximum length, whose ``append`` is atomic, so no lock is needed
+    to record from multiple threads.
+    """
+
+    DEFAULT_DUMP_FILE = '/tmp/bond_flight_recorder_{pid}.json'
+    MAX_REPR_LENGTH = 200
+
+    def __init__(self,
+                 capacity=1000,
+                 spy_groups=None,
+                 dump_file=None):
+        self.buffer = collections.deque(maxlen=capacity)
+        self.sequence = itertools.count()
+        if spy_groups is None:
+            self.spy_groups = {}
+        elif isinstance(spy_groups, basestring):
+            self.spy_groups = {spy_groups: True}
+        else:
+            self.spy_groups = {sg: True for sg in spy_groups}
+        self.dump_file = dump_file or FlightRecorder.DEFAULT_DUMP_FILE.format(pid=os.getpid())
+        self._previous_signal_handler = None
+        self._signal = None
+        self._previous_excepthook = None
+
+    def enabled_for_groups(self, enabled_for_groups):
+        """
+        Whether a spy point with the given enabled_for_groups records
+        """
+        if enabled_for_groups is None:
+            return True
+        for grp in enabled_for_groups:
+            if grp in self.spy_groups:
+                return True
+        return False
+
+    def record(self, spy_point_name, observation, kind='call'):
+        """
+        Record an invocation.
+        :param observation: the observation dictionary, of which we keep a snapshot
+        :param kind: 'call', or 'exception' when observation is the exception
+        """
+        if kind == 'call':
+            snapshot = {key: _snapshot(val) for (key, val) in observation.iteritems()}
+        else:
+            snapshot = _truncate(repr(observation))
+        self.buffer.append((next(self.sequence), time.time(), threading.current_thread().ident,
+                            kind, spy_point_name, snapshot))
+
+    def records(self):
+        """
+        Return the formatted records, oldest first
+        """
+        res = []
+        for (seq, when, thread_id, kind, spy_point_name, snapshot) in list(self.buffer):
+            rec = dict(seq=seq, time=when, thread=thread_id)
+            if kind == 'call':
+                rec['observation'] = dict(snapshot)
+                if spy_point_name is not None:
+                    rec['observation']['__spy_point__'] = spy_point_name
+            else:
+                rec['exception'] = snapshot
+                rec['spy_point'] = spy_point_name
+            res.append(rec)
+        return res
+
+    def dump(self, dump_file=None):
+        """
+        Write the records to a file, one JSON record per line
+        :return: the name of the file
+        """
+        dump_file = dump_file or self.dump_file
+        with open(dump_file, 'w') as f:
+            for rec in self.records():
+                f.write(json.dumps(rec, sort_keys=True, default=_default_json_serializer))
+                f.write('\n')
+        return dump_file
+
+    def install_signal_handler(self, signum):
+        """
+        Dump the buffer when the process receives the signal
+        """
+        def handler(_signum, _frame):
+            self.dump()
+        self._signal = signum
+        self._previous_signal_handler = signal.signal(signum, handler)
+
+    def install_excepthook(self):
+        """
+        Dump the buffer when the process exits due to an uncaught exception
+        """
+        previous_excepthook = sys.excepthook
+
+        def excepthook(exc_type, exc_value, exc_traceback):
+            print('Bond flight recorder saved to {}'.format(self.dump()), file=sys.stderr)
+            previous_excepthook(exc_type, exc_value, exc_traceback)
+        self._previous_excepthook = previous_excepthook
+        sys.excepthook = excepthook
+
+    def uninstall(self):
+        if self._signal is not None:
+            signal.signal(self._signal, self._previous_signal_handler or signal.SIG_DFL)
+            self._signal = None
+        if self._previous_excepthook is not None:
+            sys.excepthook = self._previous_excepthook
+            self._previous_excepthook = None
+
+
+# The tuples with at most this many elements are kept as tuples in the snapshots
+_MAX_SNAPSHOT_TUPLE = 10
+
+
+def _snapshot(val):
+    """
+    :return: a value of bounded size that shows val at this time
+    """
+    if val is None or isinstance(val, (bool, int, long, float)):
+        return val
+    if isinstance(val, basestring):
+        return _truncate(val)
+    if isinstance(val, tuple) and len(val) <= _MAX_SNAPSHOT_TUPLE:
+        return tuple(_snapshot(elem) for elem in val)
+    return _truncate(repr(val))
+
+
+def _truncate(text):
+    if len(text) <= FlightRecorder.MAX_REPR_LENGTH:
+        return text
+    return text[:FlightRecorder.MAX_REPR_LENGTH] + '...'
+
+
+def _default_json_serializer(obj):
+    if hasattr(obj, 'to_json'):
+        return obj.to_json()
+    return repr(obj)
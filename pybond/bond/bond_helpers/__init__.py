@@ -1,2 +1,3 @@
-from observe_files import collect_directory_contents
-from format_at import format_at
\ No newline at end of file
+from observe_files import collect_directory_contents, DirectorySnapshot
+from format_at import format_at, Rewritter
+from virtual_clock import VirtualClock
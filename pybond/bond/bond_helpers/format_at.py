@@ -1,43 +1,359 @@
 # Helper functions to rewrite observations
-import os
+import ast
+import hashlib
+import json
 import re
 
+
 def format_at(selector):
     """
-    Return a formatter for the nodes denoted by selector
-    :param selector:
-    :return:
+    Return a formatter for the nodes denoted by selector. The formatter is built by chaining
+    the rewrites to apply to the selected nodes, and can be used directly as the ``formatter``
+    of an agent:
+
+    .. code::
+
+        bond.deploy_agent('get_buses',
+                          formatter=format_at('buses[*].lat').round(2))
+
+    The selector is a path of keys separated by '.', where:
+
+    * ``key`` selects the value of the key in a dictionary
+    * ``[N]`` selects the element at index N in a list
+    * ``*`` or ``[*]`` selects all the values in a dictionary, or all the elements in a list
+    * ``**`` selects any number (including zero) of nested levels
+
+    For example, ``'buses[*].lat'``, ``'response.*.body'``, ``'**.password'``.
+
+    :param selector: the selector string
+    :return: a :py:class:`Formatter`
     """
-    pass
+    return Formatter(selector)
 
-class Formatter:
-    def __init__(selector):
-        pass
+
+def value_formatter(spec):
+    """
+    Compile the spec of a formatter for one value, e.g., for the ``formatters`` of :py:func:`bond.spy_point`.
+    The spec is one of:
+
+    * the name of an action: ``'len'``, ``'hash'``, ``'repr'``, ``'split'``
+    * an action with arguments, as for the methods of :py:class:`Formatter`: ``'truncate(200)'``,
+      ``'round(2)'``, ``'split(",")'``, ``'replace_str("a", "b")'``, ``'replace_re("[0-9]+", "N")'``
+    * a function from the value to the formatted value. It should not change the value.
+    * a list or tuple of the above, applied in order
+
+    :return: a function from the value to the formatted value
+    """
+    if isinstance(spec, (list, tuple)):
+        actions = [value_formatter(s) for s in spec]
+
+        def apply_all(value):
+            for action in actions:
+                value = action(value)
+            return value
+        return apply_all
+    if not isinstance(spec, basestring):
+        assert callable(spec), 'Invalid formatter spec: {!r}'.format(spec)
+        return spec
+    m = _VALUE_SPEC_RE.match(spec)
+    assert m is not None and m.group(1) in _VALUE_ACTIONS, 'Invalid formatter spec "{}"'.format(spec)
+    args = ast.literal_eval('(' + m.group(2) + ',)') if m.group(2) else ()
+    return _VALUE_ACTIONS[m.group(1)](*args)
 
 
 class Formatter:
     """
-    Class the holds the formatters
+    Class the holds the formatters: a selector, along with the rewrites to apply in order
+    to the selected nodes. Each rewrite method returns a new Formatter, so formatters can be
+    chained and shared. Combine several formatters with :py:class:`Rewritter`, to apply
+    them all in a single traversal of the observation.
     """
 
+    def __init__(self, selector, actions=()):
+        self.selector = selector
+        self.path = _parse_selector(selector)
+        self.actions = actions
+        self._rewritter = None
+
+    def _then(self, action):
+        return Formatter(self.selector, self.actions + (action,))
+
     def split(self, sep='\n'):
         """
         Split the string into lines
         """
-        pass
+        return self._then(_split(sep))
 
     def replace_str(self, from_str, to_str):
         """
         Replace a string with another string
         """
-        return Formatter()
+        return self._then(_replace_str(from_str, to_str))
+
+    def replace_re(self, pattern, repl):
+        """
+        Replace the matches of a regular expression, as ``re.sub``
+        """
+        return self._then(_replace_re(pattern, repl))
+
+    def truncate(self, max_len):
+        """
+        Truncate strings and lists to max_len elements. Truncated strings end with '...'
+        """
+        return self._then(_truncate(max_len))
+
+    def round(self, digits):
+        """
+        Round floats to a number of decimal digits
+        """
+        return self._then(_round(digits))
+
+    def hash(self):
+        """
+        Replace the value with a short hash of its serialization
+        """
+        return self._then(_hash())
+
+    def drop(self):
+        """
+        Remove the value from its dictionary or list
+        """
+        return self._then(_drop)
+
+    def apply(self, func):
+        """
+        Replace the value with the result of func(value)
+        """
+        return self._then(func)
+
+    def __call__(self, observation):
+        """
+        Rewrite the observation in place
+        """
+        if self._rewritter is None:
+            self._rewritter = Rewritter(self)
+        self._rewritter(observation)
+
 
 class Rewritter:
     """
-    Class that implements a variety of rewritters.
+    Class that implements a variety of rewritters. The selectors of all the formatters are
+    compiled once into a plan, which is applied in a single traversal of the observation,
+    visiting only the nodes that can be selected. Use it as the ``formatter`` of an agent:
+
+    .. code::
+
+        bond.deploy_agent('get_buses',
+                          formatter=Rewritter(format_at('buses[*].lat').round(2),
+                                              format_at('buses[*].away').drop(),
+                                              format_at('**.message').split()))
+    """
+    def __init__(self, *formatters):
+        self.paths = [f.path for f in formatters]
+        self.actions = [f.actions for f in formatters]
+        # The states are pairs of (formatter index, position in path). We compute
+        # lazily the transitions between sets of states, and cache them.
+        self.initial_states = self._closure([(idx, 0) for idx in range(len(formatters))])
+        self._transitions = {}
+        self._keys = {}
+        self._matches = {}
+
+    def _closure(self, states):
+        """
+        Add the states reachable by skipping '**' (which matches zero levels)
+        """
+        result = set()
+        todo = list(states)
+        while todo:
+            state = todo.pop()
+            if state in result:
+                continue
+            result.add(state)
+            idx, pos = state
+            path = self.paths[idx]
+            if pos < len(path) and path[pos] == _DEEP:
+                todo.append((idx, pos + 1))
+        return frozenset(result)
+
+    def _next_states(self, states, key):
+        """
+        The states for the child at key (a dictionary key, or a list index)
+        """
+        cache_key = (states, key)
+        next_states = self._transitions.get(cache_key)
+        if next_states is None:
+            res = []
+            for idx, pos in states:
+                path = self.paths[idx]
+                if pos >= len(path):
+                    continue
+                step = path[pos]
+                if step == _DEEP:
+                    res.append((idx, pos))
+                elif step == _ANY or step == key:
+                    res.append((idx, pos + 1))
+            next_states = self._closure(res)
+            self._transitions[cache_key] = next_states
+        return next_states
+
+    def _selected_keys(self, states):
+        """
+        The dictionary keys that can be selected from the states, or None for all the keys
+        """
+        keys = self._keys.get(states, False)
+        if keys is False:
+            keys = []
+            for idx, pos in states:
+                path = self.paths[idx]
+                if pos >= len(path):
+                    continue
+                step = path[pos]
+                if step == _DEEP or step == _ANY:
+                    keys = None
+                    break
+                if step not in keys:
+                    keys.append(step)
+            self._keys[states] = keys
+        return keys
+
+    def _matched_actions(self, states):
+        """
+        The actions to apply to a node, in the order of the formatters
+        """
+        actions = self._matches.get(states)
+        if actions is None:
+            actions = []
+            for idx, pos in sorted(states):
+                if pos == len(self.paths[idx]):
+                    actions.extend(self.actions[idx])
+            self._matches[states] = actions
+        return actions
+
+    def _rewrite(self, value, states):
+        """
+        Rewrite the value in place if possible, and return the new value, or _DROP
+        """
+        if isinstance(value, dict):
+            keys = self._selected_keys(states)
+            for key in (list(value.keys()) if keys is None else [k for k in keys if k in value]):
+                next_states = self._next_states(states, key)
+                if not next_states:
+                    continue
+                child = value[key]
+                new_child = self._rewrite(child, next_states)
+                if new_child is _DROP:
+                    del value[key]
+                elif new_child is not child:
+                    value[key] = new_child
+        elif isinstance(value, (list, tuple)):
+            new_elements = None
+            for idx, child in enumerate(value):
+                next_states = self._next_states(states, idx)
+                new_child = self._rewrite(child, next_states) if next_states else child
+                if new_elements is None and new_child is not child:
+                    new_elements = list(value[0:idx])
+                if new_elements is not None and new_child is not _DROP:
+                    new_elements.append(new_child)
+            if new_elements is not None:
+                if isinstance(value, list):
+                    value[:] = new_elements
+                else:
+                    value = tuple(new_elements)
+
+        for action in self._matched_actions(states):
+            value = action(value)
+            if value is _DROP:
+                break
+        return value
+
+    def __call__(self, observation):
+        """
+        Rewrite the observation in place
+        """
+        self._rewrite(observation, self.initial_states)
+
+
+# The special path steps
+_ANY = ('*',)
+_DEEP = ('**',)
+
+_SELECTOR_STEP_RE = re.compile(r'([^.\[\]]+)|\[(\*|\d+)\]|(\.)')
+
+
+def _parse_selector(selector):
     """
-    def __init__(self):
-        pass
+    Parse a selector into a tuple of steps: a dictionary key, a list index, _ANY or _DEEP
+    """
+    path = []
+    pos = 0
+    while pos < len(selector):
+        m = _SELECTOR_STEP_RE.match(selector, pos)
+        assert m is not None, 'Invalid selector "{}" at position {}'.format(selector, pos)
+        key, index, _ = m.groups()
+        if key == '**':
+            path.append(_DEEP)
+        elif key == '*' or index == '*':
+            path.append(_ANY)
+        elif key is not None:
+            path.append(key)
+        elif index is not None:
+            path.append(int(index))
+        pos = m.end()
+    return tuple(path)
+
+
+# A special value for the nodes to remove
+_DROP = object()
+
+
+def _drop(value):
+    return _DROP
+
+
+def _split(sep='\n'):
+    return lambda value: value.split(sep) if isinstance(value, basestring) else value
+
+
+def _replace_str(from_str, to_str):
+    return lambda value: value.replace(from_str, to_str) if isinstance(value, basestring) else value
+
+
+def _replace_re(pattern, repl):
+    pattern_re = re.compile(pattern)
+    return lambda value: pattern_re.sub(repl, value) if isinstance(value, basestring) else value
+
+
+def _truncate(max_len):
+    def truncate(value):
+        if isinstance(value, basestring):
+            return value if len(value) <= max_len else value[0:max_len] + '...'
+        if isinstance(value, (list, tuple)):
+            return value[0:max_len]
+        return value
+    return truncate
+
+
+def _round(digits):
+    return lambda value: round(value, digits) if isinstance(value, float) else value
+
+
+def _hash():
+    def hash_value(value):
+        serialized = json.dumps(value, sort_keys=True, separators=(',', ':'), default=repr)
+        return 'sha1:' + hashlib.sha1(serialized).hexdigest()[0:16]
+    return hash_value
 
 
+# The actions for value_formatter, by name
+_VALUE_ACTIONS = {
+    'len': lambda: len,
+    'hash': _hash,
+    'repr': lambda: repr,
+    'split': _split,
+    'replace_str': _replace_str,
+    'replace_re': _replace_re,
+    'truncate': _truncate,
+    'round': _round,
+}
 
+_VALUE_SPEC_RE = re.compile(r'^\s*(\w+)\s*(?:\((.*)\))?\s*$')
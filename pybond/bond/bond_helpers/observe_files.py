@@ -1,10 +1,33 @@
 # Helper functions to observe files and directories
+import hashlib
+import mmap
 import os
 import re
+from multiprocessing.pool import ThreadPool
+
+try:
+    # scandir gives us the type of the entries without a stat per entry. It is optional: on
+    # Python 2 it needs the scandir package, and without it we use listdir and a stat per entry
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+# Files at least this large are hashed through mmap, without reading them into memory
+LARGE_FILE_SIZE = 1024 * 1024
+
+# The number of threads used to read the file contents, when there are at least
+# PARALLEL_READ_MIN_FILES files to read
+READER_THREADS = 8
+PARALLEL_READ_MIN_FILES = 16
+
 
 def collect_directory_contents(directory,
                                file_filter=None,
-                               collect_file_contents=False):
+                               collect_file_contents=False,
+                               content_mode='lines'):
     """
     Collect an object reflecting the contents of a directory
     :param directory: the directory where to start the traversal
@@ -13,15 +36,111 @@ def collect_directory_contents(directory,
            returns true or false, whether the directory or file should be included.
     :param collect_file_contents: indicates whether to collect the contents of files.
            True means to include contents of all files,
+    :param content_mode: how to collect the contents of files: 'lines' for a list of lines
+           (with trailing whitespace removed), or 'digest' for a dictionary with the
+           size and the SHA-1 hash of the contents.
+           The directories are listed faster with ``scandir``, which on Python 2 requires the
+           optional ``scandir`` package.
     :return: a dictionary with keys corresponding to basename of files and subdirectories.
           Only files that are allowed by the file_filter are included.
-          If the file contents is collected then the dictionary contains a list of lines.
+          If the file contents is collected then the dictionary contains a list of lines,
+          or a digest.
     """
     # TODO: figure out a more general form for this, perhaps using
     #       a configurable visitor to define how to visit each file
-    result = { }  # map from file name to file data.
-                  # file data is either None (if the contents is not spied),
-                  # or an array of lines
+    result, _ = _collect(directory,
+                         _file_filter_func(file_filter),
+                         _collect_file_contents_func(collect_file_contents),
+                         _content_reader(content_mode))
+    return result
+
+
+class DirectorySnapshot:
+    """
+    Observe the same directory repeatedly. The snapshot remembers the inode, modification time,
+    size and contents of each file, and re-reads only the files that have changed since the
+    previous observation. It can produce either the full tree, as
+    :py:func:`collect_directory_contents`, or the delta since the previous observation.
+
+    .. code::
+
+        snapshot = DirectorySnapshot(output_dir, collect_file_contents=True)
+        run_build_step()
+        bond.spy('after step 1', files=snapshot.collect())
+        run_build_step()
+        bond.spy('after step 2', delta=snapshot.delta())
+    """
+
+    def __init__(self,
+                 directory,
+                 file_filter=None,
+                 collect_file_contents=False,
+                 content_mode='lines'):
+        """
+        See :py:func:`collect_directory_contents` for the parameters
+        """
+        self.directory = directory
+        self.file_filter_func = _file_filter_func(file_filter)
+        self.collect_file_contents_func = _collect_file_contents_func(collect_file_contents)
+        self.read_file = _content_reader(content_mode)
+        self.entries = {}  # Map from relative file name to _SnapshotEntry
+
+    def _refresh(self):
+        """
+        Take a new snapshot
+        :return: a pair of the tree, and the entries of the previous snapshot
+        """
+        previous_entries = self.entries
+        tree, self.entries = _collect(self.directory,
+                                      self.file_filter_func,
+                                      self.collect_file_contents_func,
+                                      self.read_file,
+                                      previous_entries=previous_entries)
+        return tree, previous_entries
+
+    def collect(self):
+        """
+        Take a new snapshot, and return the full tree, as :py:func:`collect_directory_contents`
+        """
+        tree, _ = self._refresh()
+        return tree
+
+    def delta(self):
+        """
+        Take a new snapshot, and return the changes since the previous snapshot. The first time,
+        all the files and directories are added.
+        :return: a dictionary with the sorted lists of relative names that are 'added', 'removed', and
+                 'modified'. Directories are listed only when added or removed. Files are modified when
+                 their contents has changed, or when their contents is not collected and their
+                 inode, modification time or size has changed.
+        """
+        _, previous_entries = self._refresh()
+        return dict(added=sorted(f for f in self.entries if f not in previous_entries),
+                    removed=sorted(f for f in previous_entries if f not in self.entries),
+                    modified=sorted(f for f, entry in self.entries.iteritems()
+                                    if f in previous_entries and entry.modified_since(previous_entries[f])))
+
+
+class _SnapshotEntry:
+    """
+    What a DirectorySnapshot remembers about a file or directory
+    """
+    __slots__ = ('is_dir', 'stat_key', 'content')
+
+    def __init__(self, is_dir, stat_key=None, content=None):
+        self.is_dir = is_dir
+        self.stat_key = stat_key  # (inode, modification time, size) for files
+        self.content = content  # The collected contents, or None
+
+    def modified_since(self, previous):
+        if self.is_dir or previous.is_dir:
+            return self.is_dir != previous.is_dir
+        if self.stat_key == previous.stat_key:
+            return False
+        return self.content is None or self.content != previous.content
+
+
+def _file_filter_func(file_filter):
     # Prepare the file filter
     file_filter_func = None
     if file_filter:
@@ -31,7 +150,10 @@ def collect_directory_contents(directory,
         else:
             # TODO: assert that it is a function
             file_filter_func = file_filter
+    return file_filter_func
+
 
+def _collect_file_contents_func(collect_file_contents):
     collect_file_contents_func = None
     if collect_file_contents:
         if isinstance(collect_file_contents, bool):
@@ -45,27 +167,120 @@ def collect_directory_contents(directory,
         else:
             # TODO: assert that it is a function
             collect_file_contents_func = collect_file_contents
+    return collect_file_contents_func
+
+
+def _content_reader(content_mode):
+    assert content_mode in ('lines', 'digest'), 'Unrecognized content_mode: {}'.format(content_mode)
+    return _read_file_lines if content_mode == 'lines' else _read_file_digest
+
+
+def _collect(directory,
+             file_filter_func,
+             collect_file_contents_func,
+             read_file,
+             previous_entries=None):
+    """
+    Traverse the directory, and read the contents of the selected files
+    :param previous_entries: if not None, the map from relative file name to _SnapshotEntry from a
+           previous traversal. The files whose inode, modification time and size are unchanged
+           are not read again.
+    :return: a pair of the tree, and the map of the new entries if previous_entries is not None
+    """
+    result = { }  # map from file name to file data.
+                  # file data is either None (if the contents is not spied),
+                  # or an array of lines
+    entries = {} if previous_entries is not None else None
+
+    # The files whose contents we read after the traversal: (result_data, basename, rel_file)
+    files_to_read = []
 
     def recurse(rel_subdir, result_data):
         name_subdir = os.path.join(directory, rel_subdir)
-        for basename in os.listdir(name_subdir):
+        for basename, is_dir in _list_directory(name_subdir):
             rel_file = os.path.join(rel_subdir, basename)
-            file = os.path.join(directory, rel_file)
             if file_filter_func and not file_filter_func(rel_file):
                 continue
 
-            if os.path.isdir(file):
+            if is_dir:
                 subresult_data = {}
                 result_data[basename] = subresult_data
+                if entries is not None:
+                    entries[rel_file] = _SnapshotEntry(True)
                 recurse(rel_file, subresult_data)
             else:
-                if collect_file_contents_func and collect_file_contents_func(rel_file):
-                    with open(file, 'r') as f:
-                        lines = f.readlines ()
-                    result_data[basename] = [l.rstrip() for l in lines ]
-                else:
-                    result_data[basename] = None
-
+                result_data[basename] = None
+                collect_contents = collect_file_contents_func and collect_file_contents_func(rel_file)
+                if entries is not None:
+                    st = os.stat(os.path.join(directory, rel_file))
+                    entry = _SnapshotEntry(False, stat_key=(st.st_ino, st.st_mtime, st.st_size))
+                    entries[rel_file] = entry
+                    previous = previous_entries.get(rel_file)
+                    if (collect_contents and previous is not None and not previous.is_dir and
+                            previous.stat_key == entry.stat_key and previous.content is not None):
+                        # Unchanged since the previous traversal
+                        entry.content = previous.content
+                        result_data[basename] = previous.content
+                        continue
+                if collect_contents:
+                    files_to_read.append((result_data, basename, rel_file))
 
     recurse('', result)
-    return result
+
+    file_names = [os.path.join(directory, rel_file) for (_, _, rel_file) in files_to_read]
+    if len(files_to_read) >= PARALLEL_READ_MIN_FILES:
+        pool = ThreadPool(min(READER_THREADS, len(files_to_read)))
+        try:
+            contents = pool.map(read_file, file_names)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        contents = [read_file(file) for file in file_names]
+    for (result_data, basename, rel_file), content in zip(files_to_read, contents):
+        result_data[basename] = content
+        if entries is not None:
+            entries[rel_file].content = content
+    return result, entries
+
+
+def _list_directory(dir_name):
+    """
+    Yield pairs of the basename and whether the entry is a directory
+    """
+    if _scandir is not None:
+        for entry in _scandir(dir_name):
+            yield entry.name, entry.is_dir()
+    else:
+        for basename in os.listdir(dir_name):
+            yield basename, os.path.isdir(os.path.join(dir_name, basename))
+
+
+def _read_file(file):
+    """
+    Return the contents of a file
+    """
+    with open(file, 'rb') as f:
+        return f.read()
+
+
+def _read_file_lines(file):
+    lines = _read_file(file).split('\n')
+    if lines[-1] == '':
+        lines.pop()  # The file ends with a newline
+    return [l.rstrip() for l in lines]
+
+
+def _read_file_digest(file):
+    with open(file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < LARGE_FILE_SIZE:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        else:
+            # Hash the file without copying it into memory
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest = hashlib.sha1(mapped).hexdigest()
+            finally:
+                mapped.close()
+    return dict(size=size, sha1=digest)
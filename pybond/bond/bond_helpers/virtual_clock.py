@@ -0,0 +1,78 @@
+# Helper to run time-driven code on a simulated clock
+import time
+
+from bond import bond
+
+
+class VirtualClock:
+    """
+    A simulated clock for time-driven code. Deploy it for the spy points that read
+    the time and that sleep, and the sleeps will just advance the clock. Hours of
+    simulated time then run instantly, with deterministic observations.
+
+    .. code::
+
+        clock = VirtualClock(start_time=1445567700)
+        clock.deploy(time_points='HeatWatcher.get_current_time',
+                     sleep_points='HeatWatcher.sleep')
+    """
+
+    def __init__(self, start_time=0.0):
+        self.current_time = start_time
+        self._original_time = None
+        self._original_sleep = None
+
+    def time(self, observation=None):
+        """
+        The current simulated time. Can be used as an agent result.
+        """
+        return self.current_time
+
+    def advance(self, seconds):
+        self.current_time += seconds
+
+    def deploy(self,
+               time_points=(),
+               sleep_points=(),
+               sleep_arg='seconds',
+               patch_time=False):
+        """
+        Deploy the agents for the clock, for the duration of the current test
+        :param time_points: a spy point name, or a list of spy point names, that return the current time
+        :param sleep_points: a spy point name, or a list of spy point names, that sleep
+        :param sleep_arg: the name of the argument of the sleep spy points with the number of seconds
+        :param patch_time: if True, then also replace ``time.time`` and ``time.sleep`` with the simulated
+               clock, until the end of the test
+        """
+        if isinstance(time_points, basestring):
+            time_points = (time_points,)
+        if isinstance(sleep_points, basestring):
+            sleep_points = (sleep_points,)
+
+        for spy_point_name in time_points:
+            bond.deploy_agent(spy_point_name, result=self.time)
+        for spy_point_name in sleep_points:
+            bond.deploy_agent(spy_point_name, result=lambda obs: self.advance(obs[sleep_arg]))
+        if patch_time:
+            self.patch_time()
+            bond.Bond.instance().test_framework_bridge.on_finish_test(self.unpatch_time)
+
+    def patch_time(self):
+        """
+        Replace ``time.time`` and ``time.sleep`` with the simulated clock
+        """
+        if self._original_time is None:
+            self._original_time = time.time
+            self._original_sleep = time.sleep
+            time.time = self.time
+            time.sleep = self.advance
+
+    def unpatch_time(self):
+        """
+        Restore ``time.time`` and ``time.sleep``
+        """
+        if self._original_time is not None:
+            time.time = self._original_time
+            time.sleep = self._original_sleep
+            self._original_time = None
+            self._original_sleep = None
@@ -0,0 +1,191 @@
+"""
+Memoization of the results of pure spy points, across the tests in a session, and
+optionally across sessions in an on-disk store.
+"""
+
+import collections
+import cPickle as pickle
+import hashlib
+import inspect
+import json
+import os
+import threading
+
+# The name of the on-disk store, in the observation directory
+DISK_STORE_DIRECTORY = '.bond_memoize'
+
+
+def source_hash(fn):
+    """
+    A hash of the source of a function, so that the memoized results are invalidated
+    when the function changes
+    """
+    try:
+        source = inspect.getsource(fn)
+    except (IOError, TypeError):
+        source = fn.__code__.co_code
+    return hashlib.sha1(source).hexdigest()
+
+
+def memo_key(spy_point_name, fn_source_hash, observation_dictionary, custom_json_serializer):
+    """
+    The key for memoizing a call: the canonical serialization of the arguments. We do not
+    round the floats, as we do for observations, and objects that cannot be serialized are
+    represented by their repr.
+    """
+    def serializer(obj):
+        res = custom_json_serializer(obj)
+        return res if res is not None else repr(obj)
+
+    return '{}:{}:{}'.format(spy_point_name, fn_source_hash,
+                             json.dumps(observation_dictionary,
+                                        sort_keys=True,
+                                        separators=(',', ':'),
+                                        default=serializer))
+
+
+class MemoCache:
+    """
+    An in-memory cache of pickled results, with least-recently-used eviction when the
+    total size of the pickled results exceeds max_size. We keep the results pickled so that
+    the callers cannot change the cached values.
+    """
+
+    MAX_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # Map from key to pickled result, oldest first
+        self.size = 0
+        self.lock = threading.Lock()  # The cache is shared by the concurrent Bond sessions
+
+    def get(self, key):
+        """
+        :return: a pair of whether the key was found, and the result
+        """
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is None:
+                return False, None
+            self.entries[key] = data  # Move it to the end, as the most recently used
+        return True, pickle.loads(data)
+
+    def put(self, key, result):
+        self.put_pickled(key, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+
+    def put_pickled(self, key, data):
+        with self.lock:
+            old_data = self.entries.pop(key, None)
+            if old_data is not None:
+                self.size -= len(old_data)
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_size and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class DiskMemoCache:
+    """
+    An on-disk store of pickled results, one file per key, with least-recently-used
+    eviction (based on the modification time of the files) when the total size of the
+    files exceeds max_size.
+    """
+
+    MAX_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, directory, max_size=MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+    def _file_name(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.pickle')
+
+    def get_pickled(self, key):
+        """
+        :return: the pickled result, or None
+        """
+        file_name = self._file_name(key)
+        try:
+            with open(file_name, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        os.utime(file_name, None)  # Mark it as recently used
+        return data
+
+    def put_pickled(self, key, data):
+        file_name = self._file_name(key)
+        if os.path.isfile(file_name):
+            self.size -= os.path.getsize(file_name)
+        with open(file_name, 'wb') as f:
+            f.write(data)
+        self.size += len(data)
+        if self.size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        files = []
+        for f in os.listdir(self.directory):
+            full_name = os.path.join(self.directory, f)
+            st = os.stat(full_name)
+            files.append((st.st_mtime, st.st_size, full_name))
+        files.sort()
+        self.size = sum(size for (_, size, _) in files)
+        for (_, size, full_name) in files:
+            if self.size <= self.max_size:
+                break
+            os.unlink(full_name)
+            self.size -= size
+
+
+# The in-memory cache for the session
+_memory_cache = MemoCache()
+
+# The on-disk stores, indexed by directory
+_disk_caches = {}
+
+
+def memory_cache():
+    return _memory_cache
+
+
+def disk_cache(directory):
+    cache = _disk_caches.get(directory)
+    if cache is None:
+        cache = DiskMemoCache(directory)
+        _disk_caches[directory] = cache
+    return cache
+
+
+def memoized_call(key, invoke, disk_directory=None):
+    """
+    Return the memoized result for the key, or invoke the function and memoize its result.
+    The results that cannot be pickled, e.g., functions or generators, are returned without
+    being memoized.
+    :param disk_directory: if not None, then the directory of the on-disk store to use, in
+           addition to the in-memory cache
+    """
+    found, result = _memory_cache.get(key)
+    if found:
+        return result
+
+    disk = disk_cache(disk_directory) if disk_directory is not None else None
+    if disk is not None:
+        data = disk.get_pickled(key)
+        if data is not None:
+            _memory_cache.put_pickled(key, data)
+            return pickle.loads(data)
+
+    result = invoke()
+    try:
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError):
+        return result
+    _memory_cache.put_pickled(key, data)
+    if disk is not None:
+        disk.put_pickled(key, data)
+    return result
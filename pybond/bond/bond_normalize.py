@@ -0,0 +1,115 @@
+"""
+Normalization of the volatile values in observations, such as memory addresses, names of
+temporary files, timestamps and process ids, which would otherwise differ from run to run.
+
+The rules are given with the ``normalizers`` setting, as a list whose elements are:
+
+* the name of a standard rule: ``'address'``, ``'tmp_file'``, ``'timestamp'``, or ``'pid'``
+* a pair of a regular expression (a string or a compiled pattern) and a replacement
+* a pair of a type (or a tuple of types) and a replacement, for the values of that type that
+  are not otherwise serializable to JSON
+
+The replacement is either a string, or a function that is given the matched text (for regular
+expression rules) or the value (for type rules) and returns the replacement string. In a
+replacement string ``{n}`` stands for the order in which the distinct matched values were first
+seen in the test, so that the observations still tell apart different volatile values. The
+rules with the same replacement string (ignoring surrounding double quotes) share the numbering.
+
+All the regular expressions are compiled into one alternation, which is applied in a single
+pass over the serialized observation. The replacements inside strings should not introduce quotes or
+backslashes, so that the observation remains valid JSON.
+"""
+
+import re
+import tempfile
+import types
+
+STANDARD_RULES = {
+    'address': [(r'\b0x[0-9a-fA-F]{6,16}\b', '<address {n}>')],
+    'tmp_file': [(r'(?:' + re.escape(tempfile.gettempdir()) + r'|/tmp)/(?:tmp|bond_tmp_)\w{4,}(?:\.\w+)?',
+                  '<tmp_file {n}>')],
+    'timestamp': [(r'\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?',
+                   '<timestamp {n}>')],
+    'pid': [(r'(?<=\bpid[=:])\d+|(?<=\bpid[=:] )\d+|(?<=\bpid )\d+', '<pid {n}>'),
+            # A number value for a "pid" key becomes a string
+            (r'(?<="pid": )\d+', '"<pid {n}>"')],
+}
+
+
+class Normalizer:
+    """
+    The compiled normalization rules, along with the numbering of the values seen so far
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.replacements = []  # For each rule, a pair of the replacement and a map from the seen values to numbers
+        numberings = {}  # The maps from the seen values to numbers, indexed by the replacement string
+        self.pattern_groups = []  # List of (rule index, group name in pattern_re)
+        self.type_rules = []  # List of (types, rule index)
+        patterns = []
+        if isinstance(rules, basestring):
+            rules = (rules,)
+        expanded_rules = []
+        for rule in rules:
+            if isinstance(rule, basestring):
+                assert rule in STANDARD_RULES, 'Unrecognized normalizer: {}'.format(rule)
+                expanded_rules.extend(STANDARD_RULES[rule])
+            else:
+                expanded_rules.append(rule)
+        for rule in expanded_rules:
+            assert isinstance(rule, (list, tuple)) and len(rule) == 2, \
+                'A normalizer must be a name, or a pair of a pattern or type, and a replacement: {}'.format(rule)
+            what, replacement = rule
+            idx = len(self.replacements)
+            if isinstance(replacement, basestring):
+                numbering = numberings.setdefault(replacement.strip('"'), {})
+            else:
+                numbering = None
+            self.replacements.append((replacement, numbering))
+            if isinstance(what, (type, types.ClassType, tuple)):
+                self.type_rules.append((what, idx))
+            else:
+                group_name = '_bond_{}'.format(idx)
+                patterns.append('(?P<{}>{})'.format(group_name, getattr(what, 'pattern', what)))
+                self.pattern_groups.append((idx, group_name))
+        self.pattern_re = re.compile('|'.join(patterns)) if patterns else None
+
+    def _replace(self, idx, value, key):
+        replacement, seen = self.replacements[idx]
+        if not isinstance(replacement, basestring):
+            return replacement(value)
+        n = seen.get(key)
+        if n is None:
+            n = len(seen) + 1
+            seen[key] = n
+        return replacement.format(n=n)
+
+    def _replace_match(self, match):
+        for idx, group_name in self.pattern_groups:
+            text = match.group(group_name)
+            if text is not None:
+                return self._replace(idx, text, text)
+        return match.group(0)
+
+    def normalize(self, serialized):
+        """
+        Normalize a serialized observation, in one pass
+        """
+        if self.pattern_re is None:
+            return serialized
+        return self.pattern_re.sub(self._replace_match, serialized)
+
+    def serializer(self, default_serializer):
+        """
+        Wrap a JSON serializer (the ``default`` argument of ``json.dumps``) to apply the type rules
+        """
+        if not self.type_rules:
+            return default_serializer
+
+        def serializer(obj):
+            for rule_types, idx in self.type_rules:
+                if isinstance(obj, rule_types):
+                    return self._replace(idx, obj, repr(obj))
+            return default_serializer(obj)
+        return serializer
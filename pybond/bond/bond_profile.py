@@ -0,0 +1,210 @@
+"""
+Profiling of spy points. This is kept completely separate from the observations,
+because timing data is not deterministic.
+"""
+
+from __future__ import print_function
+
+import atexit
+import json
+import os
+import threading
+import timeit
+
+# The most precise wall-clock timer on this platform
+timer = timeit.default_timer
+
+
+class SpyPointStats:
+    """
+    Call counts and a latency histogram for one spy point, or for one
+    category of Bond overhead.
+    """
+
+    # Upper bounds (in seconds) of the histogram buckets, with their labels
+    BUCKETS = ((1e-5, '<10us'),
+               (1e-4, '<100us'),
+               (1e-3, '<1ms'),
+               (1e-2, '<10ms'),
+               (1e-1, '<100ms'),
+               (1.0, '<1s'),
+               (float('inf'), '>=1s'))
+
+    def __init__(self):
+        self.count = 0  # How many times the spy point was reached
+        self.runs = 0  # How many times we have timed an execution
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * len(SpyPointStats.BUCKETS)
+
+    def add_time(self, seconds):
+        self.runs += 1
+        self.total_time += seconds
+        if seconds > self.max_time:
+            self.max_time = seconds
+        for idx, (bound, _) in enumerate(SpyPointStats.BUCKETS):
+            if seconds < bound:
+                self.histogram[idx] += 1
+                break
+
+    def merge(self, other):
+        self.count += other.count
+        self.runs += other.runs
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def histogram_str(self):
+        return ' '.join('{}:{}'.format(label, cnt)
+                        for (_, label), cnt in zip(SpyPointStats.BUCKETS, self.histogram)
+                        if cnt > 0)
+
+
+class SpyProfiler:
+    """
+    Aggregate the statistics for a test, or for a whole session
+    """
+
+    # The categories of time spent inside Bond itself
+    OVERHEAD_CATEGORIES = ('agents', 'deepcopy', 'format')
+
+    def __init__(self):
+        self.spy_points = {}  # Map from spy point name to SpyPointStats
+        self.overhead = {}  # Map from overhead category to SpyPointStats
+
+    def _stats(self, spy_point_name):
+        stats = self.spy_points.get(spy_point_name)
+        if stats is None:
+            stats = SpyPointStats()
+            self.spy_points[spy_point_name] = stats
+        return stats
+
+    def record_spy(self, spy_point_name):
+        """
+        Count one invocation of a spy point
+        """
+        self._stats(spy_point_name).count += 1
+
+    def record_run(self, spy_point_name, seconds):
+        """
+        Record the time spent in one execution of a spied function
+        """
+        self._stats(spy_point_name).add_time(seconds)
+
+    def record_overhead(self, category, seconds):
+        """
+        Record time spent by Bond itself, in one of OVERHEAD_CATEGORIES
+        """
+        stats = self.overhead.get(category)
+        if stats is None:
+            stats = SpyPointStats()
+            self.overhead[category] = stats
+        stats.count += 1
+        stats.add_time(seconds)
+
+    def merge(self, other):
+        for name, stats in other.spy_points.iteritems():
+            self._stats(name).merge(stats)
+        for category, stats in other.overhead.iteritems():
+            if category not in self.overhead:
+                self.overhead[category] = SpyPointStats()
+            self.overhead[category].merge(stats)
+
+    def empty(self):
+        return not self.spy_points and not self.overhead
+
+    def counts(self):
+        """
+        The deterministic part of the statistics: for each spy point, how many times it was
+        reached and how many times the underlying function was executed.
+        """
+        return {name: dict(count=stats.count, runs=stats.runs)
+                for name, stats in self.spy_points.iteritems()}
+
+    def report(self, title):
+        """
+        Format a report, with the spy points sorted by decreasing total time
+        """
+        lines = ['Bond profile for {}:'.format(title),
+                 '  {:<40} {:>7} {:>7} {:>10} {:>10}  {}'.format('spy point', 'calls', 'runs',
+                                                                 'total ms', 'max ms', 'histogram')]
+
+        def format_line(name, stats):
+            return '  {:<40} {:>7} {:>7} {:>10.3f} {:>10.3f}  {}'.format(name, stats.count, stats.runs,
+                                                                         stats.total_time * 1000,
+                                                                         stats.max_time * 1000,
+                                                                         stats.histogram_str())
+
+        for name, stats in sorted(self.spy_points.iteritems(),
+                                  key=lambda item: (-item[1].total_time, -item[1].count, item[0])):
+            lines.append(format_line(name, stats))
+        for category in SpyProfiler.OVERHEAD_CATEGORIES:
+            if category in self.overhead:
+                lines.append(format_line('<bond {}>'.format(category), self.overhead[category]))
+        return '\n'.join(lines)
+
+
+class SpyTracer:
+    """
+    Collect begin/end events for the spy points, to be saved in the Chrome trace-event
+    format (can be loaded in chrome://tracing). The events from each thread nest
+    following the call stack.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self.start_time = timer()
+
+    def _event(self, spy_point_name, phase):
+        # list.append is atomic, so we can collect events from multiple threads
+        self.events.append(dict(name=spy_point_name,
+                                cat='spy_point',
+                                ph=phase,
+                                ts=(timer() - self.start_time) * 1e6,  # microseconds
+                                pid=self.pid,
+                                tid=threading.current_thread().ident))
+
+    def begin(self, spy_point_name):
+        self._event(spy_point_name, 'B')
+
+    def end(self, spy_point_name):
+        self._event(spy_point_name, 'E')
+
+    def instant(self, spy_point_name):
+        """
+        An event without a duration, e.g., for a call to bond.spy
+        """
+        self._event(spy_point_name, 'i')
+
+    def save(self, trace_file):
+        with open(trace_file, 'w') as f:
+            json.dump(dict(traceEvents=self.events,
+                           displayTimeUnit='ms'), f)
+
+
+# The statistics aggregated over all the tests in this process
+_session_profiler = SpyProfiler()
+_session_profiler_lock = threading.Lock()
+
+
+def session_profiler():
+    """
+    The profiler that aggregates across all tests that ran with profiling enabled
+    """
+    return _session_profiler
+
+
+def merge_into_session(profiler):
+    """
+    Add the statistics of a test to those for the whole session
+    """
+    with _session_profiler_lock:
+        _session_profiler.merge(profiler)
+
+
+def _print_session_report():
+    if not _session_profiler.empty():
+        print(_session_profiler.report('the whole session'))
+
+atexit.register(_print_session_report)
@@ -8,6 +8,8 @@ import string
 import random
 import sys
 from bond_dialog import OptionDialog
+from bond_store import open_reference
+from bond_table import table_differences
 
 try:
     # Import bond safely
@@ -180,7 +182,8 @@ class ReconcileTool:
                   test_name,
                   reference_file,
                   current_lines,
-                  no_save=None):
+                  no_save=None,
+                  store=None):
         """
         Reconcile the differences
         @param test_name: the name of the test (for messages)
@@ -188,12 +191,21 @@ class ReconcileTool:
         @param current_lines: a list of the lines which make up the current set of observations
         :param no_save: if present, then disallows saving a new reference file.
                This parameter should be a string explaining why saving is disallowed.
+        :param store: if present, the ReferenceStore with the reference observations for test_name,
+               which is used instead of reference_file
         """
 
-        if os.path.isfile(reference_file):
-            with open(reference_file, 'r') as f:
+        if store is not None:
+            if store.matches(test_name, current_lines):
+                return True
+            reference_lines = store.read(test_name)
+        elif os.path.isfile(reference_file):
+            with open_reference(reference_file, 'r') as f:
                 reference_lines = f.readlines()
         else:
+            reference_lines = None
+
+        if reference_lines is None:
             # if we do not have the reference file, pretend we have an empty one
             ReconcileTool._print('WARNING: No reference observation file found for {}: {}'.format(test_name, reference_file))
             reference_lines = list()
@@ -204,6 +216,10 @@ class ReconcileTool:
         if len(unified_diff) == 0:
             # There are no differences
             return True
+        # Describe the differences in the tables row by row, after the diff
+        table_diff = table_differences(reference_lines, current_lines)
+        if table_diff:
+            unified_diff = unified_diff + ['\n'] + table_diff
 
         # There are differences
         merged_lines = self.invoke_tool(test_name,
@@ -218,10 +234,13 @@ class ReconcileTool:
                                                                                                no_save))
             else:
                 ReconcileTool._print('Saving updated reference observation file for {}'.format(test_name))
-                if os.path.isfile(reference_file):
-                    os.unlink(reference_file)
-                with open(reference_file, 'w') as f:
-                    f.writelines(merged_lines)
+                if store is not None:
+                    store.write(test_name, merged_lines)
+                else:
+                    if os.path.isfile(reference_file):
+                        os.unlink(reference_file)
+                    with open_reference(reference_file, 'w') as f:
+                        f.writelines(merged_lines)
             return True
         else:
             return False
@@ -433,7 +452,8 @@ def reconcile_observations(settings,
                            test_name,
                            reference_file,
                            current_lines,
-                           no_save=None):
+                           no_save=None,
+                           store=None):
     """
     Reconcile the observations
     :param settings: a settings object
@@ -441,6 +461,7 @@ def reconcile_observations(settings,
     :param current_lines: a list of all of the lines in the current set of observations
     :param no_save: If present, then saving of new references is not allowed. This parameter
             should be a short string explaining why saving is not allowed.
+    :param store: If present, the ReferenceStore to use instead of the reference file
     :return:
     """
 
@@ -448,7 +469,8 @@ def reconcile_observations(settings,
     return reconcile_tool.reconcile(test_name,
                                     reference_file,
                                     current_lines,
-                                    no_save=no_save)
+                                    no_save=no_save,
+                                    store=store)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+"""
+Stores for the reference observations.
+
+The 'files' store keeps the reference observations for each test in its own file, in a
+directory tree derived from the test name. The files larger than a threshold can be compressed
+with gzip (``.json.gz``); compressed files, including with bzip2 (``.json.bz2``), are recognized
+by their extension and decompressed as they are read. The reference files can be prefetched
+on a background thread when the test starts, so that they are read and decompressed by the
+time the test finishes; see :py:func:`prefetch_stats`. The 'sqlite' store keeps them all in one SQLite
+database in the observation directory, keyed by test name, along with a hash of the contents,
+so that unchanged observations are recognized without reading the reference. The writes to
+the database are batched in transactions.
+
+Run this module as a script to export the references from a database to the file layout, e.g.,
+for reviewing, or to import them from the file layout into a database.
+"""
+
+from __future__ import print_function
+
+import atexit
+import bz2
+import gzip
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+import Queue
+
+FILES = 'files'
+SQLITE = 'sqlite'
+
+# The name of the database for the 'sqlite' store, in the observation directory
+SQLITE_DATABASE = 'bond_observations.sqlite'
+
+
+class ReferenceStore:
+    """
+    Base class for the stores of reference observations. The observations are
+    lists of lines, including the line terminators.
+    """
+
+    def location(self, test_name):
+        """
+        A description of where the references for test_name are stored, for messages
+        """
+        assert False, 'Must override'
+
+    def read(self, test_name):
+        """
+        :return: the reference lines for test_name, or None if there is no reference
+        """
+        assert False, 'Must override'
+
+    def write(self, test_name, lines):
+        assert False, 'Must override'
+
+    def matches(self, test_name, lines):
+        """
+        :return: True if the reference for test_name is known to be equal to lines. The stores can check
+                 this without reading the whole reference. False means that it is not known.
+        """
+        return False
+
+    def prefetch(self, test_name):
+        """
+        Start reading the reference for test_name in the background, so that it is ready
+        when the test finishes. The stores that do not benefit from this ignore it.
+        """
+        pass
+
+    def test_names(self):
+        """
+        :return: the sorted list of the test names with references
+        """
+        assert False, 'Must override'
+
+    def flush(self):
+        """
+        Make sure that all the writes are saved
+        """
+        pass
+
+
+class FileStore(ReferenceStore):
+    """
+    One file for each test, named from the components of the test name
+    """
+
+    def __init__(self, observation_directory, compress_threshold=None):
+        """
+        :param compress_threshold: if not None, then the references of at least this many bytes
+               are written compressed with gzip
+        """
+        self.observation_directory = observation_directory
+        self.compress_threshold = compress_threshold
+
+    def _base_name(self, test_name):
+        return os.path.join(*[self.observation_directory] + test_name.split('.'))
+
+    def _existing_file(self, test_name):
+        base_name = self._base_name(test_name)
+        for extension in _REFERENCE_EXTENSIONS:
+            if os.path.isfile(base_name + extension):
+                return base_name + extension
+        return None
+
+    def location(self, test_name):
+        return self._existing_file(test_name) or self._base_name(test_name) + '.json'
+
+    def read(self, test_name):
+        prefetched = self._prefetched(test_name)
+        if prefetched is not None:
+            reference_file, content = prefetched
+            if reference_file is None:
+                return None
+            return list(content)
+        reference_file = self._existing_file(test_name)
+        if reference_file is None:
+            return None
+        with open_reference(reference_file, 'r') as f:
+            return f.readlines()
+
+    def matches(self, test_name, lines):
+        prefetched = self._prefetched(test_name)
+        if prefetched is not None:
+            reference_file, content = prefetched
+            return reference_file is not None and content == lines
+        # We compare as we read, so that we stop at the first difference
+        # and we do not keep the whole reference in memory
+        reference_file = self._existing_file(test_name)
+        if reference_file is None:
+            return False
+        with open_reference(reference_file, 'r') as f:
+            count = 0
+            for line in f:
+                if count >= len(lines) or line != lines[count]:
+                    return False
+                count += 1
+            return count == len(lines)
+
+    def prefetch(self, test_name):
+        _prefetcher.request(self._base_name(test_name), lambda: self._load(test_name))
+
+    def _load(self, test_name):
+        """
+        Read a reference for prefetching
+        :return: the reference file, or None if missing, and its lines
+        """
+        reference_file = self._existing_file(test_name)
+        if reference_file is None:
+            return None, None
+        with open_reference(reference_file, 'r') as f:
+            return reference_file, f.readlines()
+
+    def _prefetched(self, test_name):
+        return _prefetcher.get(self._base_name(test_name))
+
+    def write(self, test_name, lines):
+        base_name = self._base_name(test_name)
+        _prefetcher.discard(base_name)
+        reference_dir = os.path.dirname(base_name)
+        if not os.path.isdir(reference_dir):
+            os.makedirs(reference_dir)
+        for extension in _REFERENCE_EXTENSIONS:
+            if os.path.isfile(base_name + extension):
+                os.unlink(base_name + extension)
+        if self.compress_threshold is not None and sum(len(line) for line in lines) >= self.compress_threshold:
+            reference_file = base_name + '.json.gz'
+        else:
+            reference_file = base_name + '.json'
+        with open_reference(reference_file, 'w') as f:
+            f.writelines(lines)
+
+    def test_names(self):
+        res = []
+        for dir_name, _, file_names in os.walk(self.observation_directory):
+            rel_dir = os.path.relpath(dir_name, self.observation_directory)
+            prefix = '' if rel_dir == '.' else rel_dir.replace(os.sep, '.') + '.'
+            for file_name in file_names:
+                if file_name.endswith(_NON_REFERENCE_SUFFIXES):
+                    continue
+                for extension in _REFERENCE_EXTENSIONS:
+                    if file_name.endswith(extension):
+                        res.append(prefix + file_name[0:-len(extension)])
+                        break
+        return sorted(res)
+
+
+# The extensions of the reference files, in the order in which we look for them
+_REFERENCE_EXTENSIONS = ('.json', '.json.gz', '.json.bz2')
+
+# The other JSON files that we keep next to the reference observations
+_NON_REFERENCE_SUFFIXES = ('_now.json', '.trace.json', '.cassette.json')
+
+
+def open_reference(reference_file, mode):
+    """
+    Open a reference file, compressed or not depending on its extension
+    :param mode: 'r' or 'w'
+    """
+    if reference_file.endswith('.gz'):
+        if mode == 'r':
+            return gzip.open(reference_file, 'rb')
+        # We do not record the file name and time, so that the same observations
+        # compress to the same file
+        return _GzipWriter(reference_file)
+    if reference_file.endswith('.bz2'):
+        return bz2.BZ2File(reference_file, mode + 'b')
+    return open(reference_file, mode)
+
+
+class _GzipWriter(gzip.GzipFile):
+    def __init__(self, reference_file):
+        self.raw_file = open(reference_file, 'wb')
+        gzip.GzipFile.__init__(self, filename='', mode='wb', fileobj=self.raw_file, mtime=0)
+
+    def close(self):
+        try:
+            gzip.GzipFile.close(self)
+        finally:
+            self.raw_file.close()
+
+
+class _Prefetch:
+    """
+    A reference being read in the background
+    """
+    def __init__(self, load):
+        self.load = load
+        self.done = threading.Event()
+        self.result = None  # The result of load, or None if it failed
+        self.used = False
+
+
+# Marks a reference that was needed before it was prefetched
+_MISSED = 'missed'
+
+
+class _Prefetcher:
+    """
+    Reads references on a background thread. The references are prefetched one test at a time for
+    each thread running tests, so a new request drops the previous ones from the same thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.entries = {}  # Map from a key to the _Prefetch for it, or _MISSED
+        self.thread_keys = {}  # Map from the id of a thread to the keys it requested, or missed, since its last request
+        self.stats = dict(requests=0, hits=0, waits=0, misses=0, unused=0, wait_time=0.0)
+
+    def request(self, key, load):
+        """
+        Start prefetching, with load() returning the value to be prefetched for the key
+        """
+        prefetch = _Prefetch(load)
+        with self.lock:
+            for previous_key in self.thread_keys.pop(threading.current_thread().ident, ()):
+                previous = self.entries.pop(previous_key, None)
+                if previous is not None and previous is not _MISSED and not previous.used:
+                    self.stats['unused'] += 1
+            self.entries[key] = prefetch
+            self._add_thread_key(key)
+            self.stats['requests'] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='bond-prefetch')
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put(prefetch)
+
+    def get(self, key):
+        """
+        :return: the value prefetched for the key, waiting for it if necessary, or None if
+                 it was not prefetched
+        """
+        with self.lock:
+            prefetch = self.entries.get(key)
+            if prefetch is None and self.stats['requests'] > 0:
+                # Count each reference missed only once
+                self.entries[key] = _MISSED
+                self._add_thread_key(key)
+                self.stats['misses'] += 1
+            if prefetch is None or prefetch is _MISSED:
+                return None
+            first_use = not prefetch.used
+            prefetch.used = True
+        if prefetch.done.is_set():
+            if first_use:
+                with self.lock:
+                    self.stats['hits'] += 1
+        else:
+            start = time.time()
+            prefetch.done.wait()
+            if first_use:
+                with self.lock:
+                    self.stats['waits'] += 1
+                    self.stats['wait_time'] += time.time() - start
+        return prefetch.result
+
+    def _add_thread_key(self, key):
+        self.thread_keys.setdefault(threading.current_thread().ident, []).append(key)
+
+    def discard(self, key):
+        """
+        Drop what was prefetched for the key, e.g., when the reference changes
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stop(self):
+        """
+        Stop the background thread, e.g., before the process exits
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            prefetch = self.queue.get()
+            if prefetch is None:
+                return
+            try:
+                prefetch.result = prefetch.load()
+            except Exception:
+                # The reference will be read again when needed, and the error reported then
+                prefetch.result = None
+            prefetch.done.set()
+
+
+_prefetcher = _Prefetcher()
+
+
+def prefetch_stats():
+    """
+    The statistics of the prefetching of reference files, for tuning:
+
+    * ``requests``: the number of references that were prefetched
+    * ``hits``: the number of references that were ready when needed
+    * ``waits``: the number of references that were still being read when needed
+    * ``wait_time``: the total time waited for them, in seconds
+    * ``misses``: the number of references needed without having been prefetched, while prefetching is in use
+    * ``unused``: the number of prefetched references that were not needed, e.g., because
+      the observation directory was changed
+
+    :return: a dictionary with the statistics
+    """
+    with _prefetcher.lock:
+        return dict(_prefetcher.stats)
+
+
+class SqliteStore(ReferenceStore):
+    """
+    All the references in one SQLite database. The writes are kept pending until there are
+    BATCH_SIZE of them, or until the store is flushed, and then saved in one transaction.
+    The store is used by the concurrent Bond sessions and by the write-behind thread, so the
+    pending writes and the connection are used under a lock.
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self, database_file, batch_size=BATCH_SIZE):
+        self.database_file = database_file
+        self.batch_size = batch_size
+        self.pending = {}  # Map from test name to (hash, content) of the writes not saved yet
+        self.lock = threading.RLock()
+        database_dir = os.path.dirname(database_file)
+        if database_dir and not os.path.isdir(database_dir):
+            os.makedirs(database_dir)
+        self.connection = sqlite3.connect(database_file, check_same_thread=False)
+        self.connection.text_factory = str
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS observations '
+                                    '(test_name TEXT PRIMARY KEY, hash TEXT NOT NULL, content TEXT NOT NULL)')
+
+    def location(self, test_name):
+        return '{}:{}'.format(self.database_file, test_name)
+
+    def read(self, test_name):
+        with self.lock:
+            pending = self.pending.get(test_name)
+            if pending is not None:
+                content = pending[1]
+            else:
+                row = self.connection.execute('SELECT content FROM observations WHERE test_name = ?',
+                                              (test_name,)).fetchone()
+                if row is None:
+                    return None
+                content = row[0]
+        return content.splitlines(True)
+
+    def write(self, test_name, lines):
+        content = ''.join(lines)
+        with self.lock:
+            self.pending[test_name] = (_content_hash(content), content)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def matches(self, test_name, lines):
+        with self.lock:
+            pending = self.pending.get(test_name)
+            if pending is not None:
+                reference_hash = pending[0]
+            else:
+                row = self.connection.execute('SELECT hash FROM observations WHERE test_name = ?',
+                                              (test_name,)).fetchone()
+                if row is None:
+                    return False
+                reference_hash = row[0]
+        return reference_hash == _content_hash(''.join(lines))
+
+    def test_names(self):
+        with self.lock:
+            names = set(row[0] for row in self.connection.execute('SELECT test_name FROM observations'))
+            names.update(self.pending)
+        return sorted(names)
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO observations (test_name, hash, content) '
+                                            'VALUES (?, ?, ?)',
+                                            [(test_name, content_hash, content)
+                                             for test_name, (content_hash, content) in self.pending.iteritems()])
+            self.pending = {}
+
+
+def _content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+# The stores in use, indexed by kind, observation directory, and compress threshold for FILES.
+# The stores are shared by the concurrent Bond sessions, so we do not change their settings.
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def reference_store(kind, observation_directory, compress_threshold=None):
+    """
+    :param kind: FILES or SQLITE
+    :param compress_threshold: the size from which to compress the reference files, for FILES
+    :return: the store of that kind for the observation directory
+    """
+    assert kind in (FILES, SQLITE), 'Unrecognized observation store: {}'.format(kind)
+    key = (kind, observation_directory, compress_threshold if kind == FILES else None)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            if kind == FILES:
+                store = FileStore(observation_directory, compress_threshold=compress_threshold)
+            else:
+                store = SqliteStore(os.path.join(observation_directory, SQLITE_DATABASE))
+            _stores[key] = store
+    return store
+
+
+def flush_stores():
+    """
+    Save the pending writes in all the stores
+    """
+    with _stores_lock:
+        stores = _stores.values()
+    for store in stores:
+        store.flush()
+
+
+atexit.register(flush_stores)
+atexit.register(_prefetcher.stop)
+
+
+def copy_references(from_store, to_store):
+    """
+    Copy all the references from a store to another
+    :return: the number of references copied
+    """
+    test_names = from_store.test_names()
+    for test_name in test_names:
+        to_store.write(test_name, from_store.read(test_name))
+    to_store.flush()
+    return len(test_names)
+
+
+if __name__ == '__main__':
+    import optparse
+
+    optParser = optparse.OptionParser(usage='{} [options] export|import'.format(os.path.basename(__file__)),
+                                      description='Export the reference observations from a SQLite database '
+                                                  'to the file layout, or import them from the file layout')
+
+    optParser.add_option('--observation-directory', dest='observation_directory', action='store', default=None,
+                         help='The directory with the reference observation files')
+    optParser.add_option('--database', dest='database', action='store', default=None,
+                         help='The SQLite database. Default is {} in the observation directory'
+                         .format(SQLITE_DATABASE))
+    (opts, args) = optParser.parse_args()
+    if opts.observation_directory is None or len(args) != 1 or args[0] not in ('export', 'import'):
+        optParser.print_help()
+        sys.exit(1)
+
+    file_store = FileStore(opts.observation_directory)
+    sqlite_store = SqliteStore(opts.database or os.path.join(opts.observation_directory, SQLITE_DATABASE))
+    if args[0] == 'export':
+        count = copy_references(sqlite_store, file_store)
+    else:
+        count = copy_references(file_store, sqlite_store)
+    print('Copied {} reference observations'.format(count))
@@ -0,0 +1,202 @@
+"""
+Observations of tables.
+
+A table is observed as the value of the ``__table__`` key of an observation: a list whose first
+element is the list of the column names, followed by the list of the cells of each row. In the
+reference files, each of these lists is shown on one line, so that the column names are not
+repeated for each row, and a difference in a row is a difference in one line.
+"""
+
+import difflib
+import json
+
+TABLE_KEY = '__table__'
+
+# The line that starts a table, in an observation indented by 4
+_TABLE_START = '    "{}": ['.format(TABLE_KEY)
+_ROW_INDENT = ' ' * 8
+
+
+def make_table(rows, columns=None, sort_key=None):
+    """
+    :param rows: a list of dictionaries, or of sequences with the cells in the order of the columns
+    :param columns: the list of the column names. By default, the sorted keys of all the rows, which
+           must then be dictionaries. The cells for the columns that are missing from a dictionary are None.
+    :param sort_key: if not None, the rows are sorted, in a stable way, by this key: a column name, a list
+           of column names, or a function that is given the row as a dictionary
+    :return: the table, as a list of the column names followed by the list of the cells of each row
+    """
+    rows = list(rows)
+    if columns is None:
+        keys = set()
+        for row in rows:
+            assert isinstance(row, dict), 'The columns must be given for rows that are not dictionaries'
+            keys.update(row.keys())
+        columns = sorted(keys)
+    else:
+        columns = list(columns)
+    cells = []
+    for row in rows:
+        if isinstance(row, dict):
+            cells.append([row.get(column) for column in columns])
+        else:
+            row = list(row)
+            assert len(row) == len(columns), \
+                'Row with {} cells for {} columns: {}'.format(len(row), len(columns), row)
+            cells.append(row)
+
+    if sort_key is not None:
+        if isinstance(sort_key, basestring):
+            idx = columns.index(sort_key)
+            cells.sort(key=lambda row: row[idx])
+        elif isinstance(sort_key, (list, tuple)):
+            indices = [columns.index(column) for column in sort_key]
+            cells.sort(key=lambda row: [row[idx] for idx in indices])
+        else:
+            cells.sort(key=lambda row: sort_key(dict(zip(columns, row))))
+    return [columns] + cells
+
+
+def compact_tables(formatted):
+    """
+    Show each row of the table in an observation on one line
+    :param formatted: the observation, indented by 4, as json.dumps(indent=4) shows it
+    :return: the observation, with the rows of its table on one line each
+    """
+    if '\n' + _TABLE_START not in formatted:
+        return formatted
+    lines = formatted.split('\n')
+    result = []
+    row = None  # The lines of the row that we are joining
+    in_table = False
+    for line in lines:
+        if not in_table:
+            result.append(line)
+            in_table = (line == _TABLE_START)
+        elif row is not None:
+            row.append(line.lstrip(' '))
+            if line.startswith(_ROW_INDENT) and line[len(_ROW_INDENT)] in ']}':
+                result.append(_ROW_INDENT + ''.join(row))
+                row = None
+        elif not line.startswith(_ROW_INDENT):
+            # The end of the table
+            result.append(line)
+            in_table = False
+        elif line.endswith('[') or line.endswith('{'):
+            row = [line.lstrip(' ')]
+        else:
+            result.append(line)
+    return '\n'.join(result)
+
+
+def table_differences(reference_lines, current_lines):
+    """
+    Describe the differences between the tables in two observation files, row by row. The tables are
+    matched by their spy point, in order.
+    :return: the lines of the description, empty if there are no differences in the tables
+    """
+    reference_tables = _tables(reference_lines)
+    current_tables = _tables(current_lines)
+    result = []
+    for key in sorted(set(reference_tables.keys()) & set(current_tables.keys())):
+        reference_table = reference_tables[key]
+        current_table = current_tables[key]
+        if reference_table == current_table:
+            continue
+        spy_point, occurrence = key
+        result.append('Differences in table {} #{}:\n'.format(spy_point if spy_point is not None else '<unnamed>',
+                                                              occurrence + 1))
+        reference_columns = json.loads(reference_table[0])
+        current_columns = json.loads(current_table[0])
+        if reference_columns != current_columns:
+            result.append('  columns changed: {} -> {}\n'.format(reference_table[0], current_table[0]))
+        common_columns = [column for column in reference_columns if column in current_columns]
+        reference_rows = reference_table[1:]
+        current_rows = current_table[1:]
+        matcher = difflib.SequenceMatcher(None, reference_rows, current_rows, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            reference_block = [dict(zip(reference_columns, _cells(row))) for row in reference_rows[i1:i2]]
+            current_block = [dict(zip(current_columns, _cells(row))) for row in current_rows[j1:j2]]
+            j = 0
+            for i, reference_cells in enumerate(reference_block):
+                # The next current row that has the same cells for at least half of the common columns
+                match = next((k for k in range(j, len(current_block))
+                              if common_columns and
+                              2 * _same_cells(reference_cells, current_block[k]) >= len(common_columns)), None)
+                if match is None:
+                    result.append('  row {} removed: {}\n'.format(i1 + i + 1, reference_rows[i1 + i]))
+                    continue
+                for k in range(j, match):
+                    result.append('  row {} added: {}\n'.format(j1 + k + 1, current_rows[j1 + k]))
+                current_cells = current_block[match]
+                cell_changes = ['{}: {} -> {}'.format(column, reference_cells.get(column), current_cells.get(column))
+                                for column in common_columns
+                                if reference_cells.get(column) != current_cells.get(column)]
+                if cell_changes:
+                    result.append('  row {} changed: {}\n'.format(j1 + match + 1, '; '.join(cell_changes)))
+                j = match + 1
+            for k in range(j, len(current_block)):
+                result.append('  row {} added: {}\n'.format(j1 + k + 1, current_rows[j1 + k]))
+    return result
+
+
+def _tables(lines):
+    """
+    :return: a map from the spy point and the occurrence of the tables in the lines of an
+             observation file, to the lines of each table, without the trailing separators
+    """
+    tables = {}
+    spy_point = None
+    table = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if table is not None:
+            if line.startswith(_ROW_INDENT):
+                table.append(_strip_separator(line[len(_ROW_INDENT):]))
+                continue
+            occurrence = 0
+            while (spy_point, occurrence) in tables:
+                occurrence += 1
+            tables[(spy_point, occurrence)] = table
+            table = None
+        if line == '{':
+            spy_point = None
+        elif line.startswith('    "__spy_point__": '):
+            try:
+                spy_point = json.loads(_strip_separator(line[len('    "__spy_point__": '):]))
+            except ValueError:
+                pass
+        elif line == _TABLE_START:
+            table = []
+    return tables
+
+
+def _same_cells(reference_cells, current_cells):
+    """
+    :return: the number of columns with the same cells in two rows
+    """
+    return sum(1 for column, cell in reference_cells.items() if current_cells.get(column) == cell)
+
+
+def _strip_separator(text):
+    text = text.rstrip(' ')
+    return text[:-1] if text.endswith(',') else text
+
+
+def _cells(row):
+    """
+    :return: the text of each cell in the line for a row
+    """
+    decoder = json.JSONDecoder()
+    cells = []
+    idx = 1
+    try:
+        while row[idx] != ']':
+            _, end = decoder.raw_decode(row, idx)
+            cells.append(row[idx:end])
+            idx = end + 2 if row[end] == ',' else end
+    except (ValueError, IndexError):
+        return [row]
+    return cells
@@ -0,0 +1,206 @@
+"""
+A plugin for pytest.
+
+Enable it with ``-p bond.pytest_plugin`` on the command line, or with
+``pytest_plugins = ['bond.pytest_plugin']`` in ``conftest.py``. It provides:
+
+* a ``bond`` fixture, which starts a Bond test for a plain test function, and yields the ``bond`` module:
+
+  .. code::
+
+      def test_something(bond):
+          bond.spy('result', value=compute())
+
+* the detection of the failures of the tests from the pytest reports. This applies also to the
+  ``unittest.TestCase`` tests that call ``bond.start_test(self)``.
+
+* the support for pytest-xdist. Each worker process compares the observations of its tests with the
+  reference observations, and fails the tests with differences if the reconcile method is ``abort``.
+  For the other reconcile methods, the observations with differences are sent to the controller, which
+  reconciles them, in the order of the test names, at the end of the session, so that a run with
+  ``-n auto`` saves the same reference observations as a serial run. If some differences are not
+  accepted, the session fails.
+
+The tests that are finished in the background (see the ``write_behind`` setting) are joined at the end
+of the session, which fails if their observations differ from the reference.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+import pytest
+
+import bond as bond_module
+import bond_background
+import bond_store
+
+
+# The reconcilers of the tests with differences, in the form of ObservationReconciler.to_json.
+# On a worker, these are sent to the controller. On the controller, these are received from the workers.
+_deferred = []
+
+# The names of the tests finished in the background with differences, received from the workers
+_mismatches = []
+
+# The item for the test that is running
+_current_item = None
+
+
+class PytestBridge(bond_module.TestFrameworkBridge):
+    """
+    A bridge for a pytest item. The test is finished when the report for running it is made.
+    """
+
+    def __init__(self, item, current_python_test=None):
+        bond_module.TestFrameworkBridge.__init__(self, current_python_test)
+        self.item = item
+        self.finish_callbacks = []  # Called at the end of the test, in reverse order, as with addCleanup
+        self.failure = None  # The report of the failure of the test, if it failed
+
+    def full_test_name(self):
+        if self.item.cls is not None:
+            return self.item.cls.__name__ + '.' + self.item.name
+        module_name = os.path.splitext(os.path.basename(str(self.item.fspath)))[0]
+        return module_name + '.' + self.item.name
+
+    def test_file_name(self):
+        return str(self.item.fspath)
+
+    def on_finish_test(self, _callback):
+        self.finish_callbacks.append(_callback)
+
+    def test_failed(self):
+        return self.failure
+
+    def reconcile(self, reconciler):
+        if not _is_worker(self.item.config):
+            return reconciler()
+        if reconciler.matches():
+            return True
+        if (reconciler.reconcile or os.environ.get('BOND_RECONCILE', 'console')) == 'abort':
+            # Nothing to save, so we show the differences here, and fail the test
+            return reconciler()
+        _deferred.append(reconciler.to_json())
+        return True
+
+    def finish(self, failure=None):
+        """
+        Finish the test, if not finished already
+        :param failure: the description of the failure of the test, if it failed
+        """
+        callbacks, self.finish_callbacks = self.finish_callbacks, []
+        if callbacks:
+            self.failure = failure
+        error = None
+        for callback in reversed(callbacks):
+            # As with addCleanup, the other callbacks are called even if one fails
+            try:
+                callback()
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+
+def _is_worker(config):
+    return hasattr(config, 'workerinput')
+
+
+def _bridge_factory(current_python_test):
+    # For the unittest.TestCase tests that call bond.start_test(self)
+    item = _current_item
+    if item is not None and getattr(item, '_testcase', None) is current_python_test:
+        bridge = PytestBridge(item, current_python_test)
+        item._bond_bridge = bridge
+        return bridge
+    return None
+
+
+@pytest.fixture
+def bond(request):
+    """
+    Start a Bond test, and yield the ``bond`` module
+    """
+    bridge = PytestBridge(request.node)
+    request.node._bond_bridge = bridge
+    bond_module.start_test(bridge)
+    yield bond_module
+    # If the test was not finished when its report was made, e.g., because its setup failed
+    bridge.finish(failure='The setup of the test failed')
+
+
+def pytest_configure(config):
+    bond_module.TestFrameworkBridge.bridge_factory = staticmethod(_bridge_factory)
+
+
+def pytest_unconfigure(config):
+    bond_module.TestFrameworkBridge.bridge_factory = None
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    global _current_item
+    _current_item = item
+    try:
+        yield
+    finally:
+        _current_item = None
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    outcome = yield
+    bridge = getattr(item, '_bond_bridge', None)
+    if bridge is None or call.when != 'call':
+        return
+    report = outcome.get_result()
+    try:
+        bridge.finish(failure=report.longreprtext if report.failed else None)
+    except Exception as e:
+        # The observations differ from the reference
+        report.outcome = 'failed'
+        report.longrepr = '{}: {}'.format(e.__class__.__name__, e)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    config = session.config
+    finished, mismatches = bond_background.finisher().join()
+    if _is_worker(config):
+        config.workeroutput['bond_deferred'] = list(_deferred)
+        config.workeroutput['bond_mismatches'] = mismatches
+        return
+
+    mismatches = sorted(_mismatches + mismatches)
+    if _deferred:
+        # The reconcile may interact with the user
+        capture_manager = config.pluginmanager.getplugin('capturemanager')
+        if capture_manager is not None:
+            capture_manager.suspend_global_capture(in_=True)
+        try:
+            for value in sorted(_deferred, key=lambda v: v['test_name']):
+                try:
+                    accepted = bond_module.ObservationReconciler.from_json(value)()
+                except Exception as e:
+                    print('Error reconciling the observations for {}: {}'.format(value['test_name'], e))
+                    accepted = False
+                if not accepted:
+                    mismatches.append(value['test_name'])
+        finally:
+            if capture_manager is not None:
+                capture_manager.resume_global_capture()
+    bond_store.flush_stores()
+    if mismatches:
+        print('\nReconciling observations failed for {} test(s):\n  {}'.format(len(mismatches),
+                                                                              '\n  '.join(mismatches)))
+        session.exitstatus = 1
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    # On the controller, when a pytest-xdist worker is done
+    output = getattr(node, 'workeroutput', {})
+    _deferred.extend(output.get('bond_deferred', []))
+    _mismatches.extend(output.get('bond_mismatches', []))
@@ -182,6 +182,149 @@ class AnnotationTests(unittest.TestCase):
         bond.deploy_agent('AnnotationTests.mock_only_method', skip_save_observation=False, result='mocked value')
         bond.spy('mocked_return', val=self.mock_only_method())
 
+    @bond.spy_point(when=lambda self, arg1, arg2=None: arg1 % 2 == 0)
+    def guarded_method(self, arg1, arg2=None):
+        return 'normal value'
+
+    @bond.spy_point()
+    def agent_guarded_method(self, x):
+        return x
+
+    @bond.spy_point(require_agent_result=True)
+    def run_shell(self, cmd):
+        self.commands_run.append(cmd)
+        return 'real ' + cmd
+
+    def test_when(self):
+        "Only the calls accepted by the guards are spied"
+        bond.deploy_agent('AnnotationTests.guarded_method', result='mocked value')
+        results = [self.guarded_method(i) for i in range(4)]
+        bond.spy('results', results=results)
+
+        bond.deploy_agent('AnnotationTests.guarded_method', when=lambda self, arg1, arg2=None: arg2 is not None,
+                          result='mocked again')
+        results = [self.guarded_method(i, arg2=(i if i > 1 else None)) for i in range(4)]
+        bond.spy('results_agent_guard', results=results)
+
+    def test_when_agents(self):
+        "The guard of an agent only disqualifies that agent"
+        bond.deploy_agent('AnnotationTests.agent_guarded_method', when=lambda self, x: x > 5, result='big')
+        bond.deploy_agent('AnnotationTests.agent_guarded_method', when=lambda self, x: x < 2, result='small')
+        bond.spy('results', results=[self.agent_guarded_method(x) for x in (10, 0, 3)])
+
+        # An agent without a guard applies to all the calls
+        bond.deploy_agent('AnnotationTests.agent_guarded_method', x=4, result='four')
+        bond.spy('results_unguarded_agent', results=[self.agent_guarded_method(x) for x in (10, 3, 4)])
+
+    def test_when_require_agent_result(self):
+        "The calls that the guards reject must still be mocked"
+        self.commands_run = []
+        bond.deploy_agent('AnnotationTests.run_shell', when=lambda self, cmd: cmd.startswith('ls'), result='mocked')
+        result = self.run_shell('ls -l')
+        self.assertRaises(AssertionError, self.run_shell, 'rm -rf /important')
+        bond.spy('run_shell', result=result, commands_run=self.commands_run)
+
+    def test_when_not_building_observation(self):
+        "The rejected calls do not build the observation, nor apply the agents"
+        seen = []
+        bond.deploy_agent('AnnotationTests.guarded_method', do=lambda obs: seen.append(obs['arg1']),
+                          result='mocked value')
+        self.guarded_method(1, arg2=Uncopyable())
+        self.guarded_method(2)
+        bond.deploy_agent('AnnotationTests.agent_guarded_method', when=lambda self, x: x is not None,
+                          do=lambda obs: seen.append(obs['x']))
+        self.agent_guarded_method(None)
+        self.agent_guarded_method(3)
+        bond.spy('seen', seen=seen)
+
+    @bond.spy_point(include_keys=('url', 'body', 'timeout', 'self'),
+                    formatters=dict(url='truncate(12)', body=['len'], timeout='round(1)'))
+    def projected_method(self, url, headers, body, timeout=1.0):
+        return 'normal value'
+
+    def test_include_keys_and_formatters(self):
+        "Only the included keys are observed, formatted before they are copied"
+        seen = []
+        bond.deploy_agent('AnnotationTests.projected_method', do=lambda obs: seen.append(sorted(obs.keys())))
+        self.projected_method('http://example.com/path', Uncopyable(), 'x' * 1000, timeout=2.345)
+        self.projected_method('http://a.b', Uncopyable(), [1, 2])
+        bond.spy('seen', seen=seen)
+
+
+class Uncopyable:
+    def __deepcopy__(self, memo):
+        raise Exception('Must not copy')
+
+
+@bond.spy_class(exclude=('not_spied',), spy_result=True)
+class Service(object):
+    def __init__(self, name):
+        self.name = name
+
+    def get(self, key, default=None):
+        return self._lookup(key) or default
+
+    def _lookup(self, key):
+        return self.name + ':' + key if key else None
+
+    @staticmethod
+    def parse(text):
+        return text.split(',')
+
+    @classmethod
+    def create(cls, name):
+        return cls(name)
+
+    def not_spied(self):
+        return 'not spied'
+
+    @bond.spy_point(spy_point_name='Service.custom_name')
+    def already_spied(self, val):
+        return val
+
+
+class SubService(Service):
+    pass
+
+
+@bond.spy_class(include=('get',), groups='services', mock_only=True)
+class GroupedService:
+    def get(self, key):
+        return 'real ' + key
+
+    def put(self, key):
+        return 'not spied'
+
+
+class SpyClassTests(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+
+    def test_spy_class(self):
+        "The methods of the class are spied, with the name of the class"
+        service = Service.create('svc')
+        service.get('a')
+        service.get('', default='d')
+        Service.parse('x,y')
+        service.parse('z')
+        service.not_spied()
+        service.already_spied(1)
+        SubService('sub').get('b')
+        bond.spy('class', name=SubService.create('sub2').name)
+
+    def test_spy_class_groups(self):
+        "The spy points are only in the groups of the class"
+        bond.deploy_agent('GroupedService.get', result='mocked')
+        bond.spy('not_enabled', get=GroupedService().get('k'))
+        bond.settings(spy_groups='services')
+        bond.spy('enabled', get=GroupedService().get('k'), put=GroupedService().put('k'))
+
+    def test_spy_class_include(self):
+        "The included methods must be defined in the class"
+        self.assertRaises(AssertionError, bond.spy_class(include=('missing',)), Service)
+
+
 @bond.spy_point(spy_result=True)
 def annotated_module_method(arg1, arg2='2'):
     return 'something'
@@ -0,0 +1,92 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import setup_paths_test
+from bond import bond, bond_background
+from bond_test import setup_bond_self_test
+
+
+# A test module that finishes its tests in the background
+_TEST_MODULE = '''
+import os
+import unittest
+from bond import bond
+
+
+def tearDownModule():
+    if os.environ.get('FINISH_SESSION'):
+        finished = bond.finish_session()
+        print('Finished {} tests'.format(finished))
+
+
+class WriteBehindTest(unittest.TestCase):
+
+    def setUp(self):
+        bond.start_test(self, observation_directory=os.path.dirname(__file__), write_behind=True)
+
+    def test_same(self):
+        bond.spy('same', value=1)
+
+    def test_changed(self):
+        bond.spy('changed', value=os.environ.get('CHANGED', 'original'))
+
+    def test_also_changed(self):
+        bond.spy('also_changed', value=os.environ.get('CHANGED', 'original'))
+'''
+
+
+class BackgroundTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_tests(self, reconcile, **env):
+        "Run the test module in a separate process, and return its exit status and the relevant output"
+        with open(os.path.join(self.tmp_dir, 'write_behind_test.py'), 'w') as f:
+            f.write(_TEST_MODULE)
+        env = dict(os.environ, BOND_RECONCILE=reconcile,
+                   PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(bond.__file__))), self.tmp_dir]),
+                   **env)
+        process = subprocess.Popen([sys.executable, '-m', 'unittest', 'write_behind_test'],
+                                   cwd=self.tmp_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Bond prints to stdout, and the test runner to stderr, so they do not interleave
+        stdout, stderr = process.communicate()
+
+        def relevant_lines(output, markers):
+            lines = []
+            for line in output.split('\n'):
+                for marker in markers:
+                    if marker in line:
+                        lines.append(line[line.index(marker):].strip().replace('\033[0m', ''))
+                        break
+            return lines
+        return dict(exit_status=process.returncode,
+                    output=relevant_lines(stdout, ('Aborting', 'Finished')),
+                    runner_output=relevant_lines(stderr, ('AssertionError', 'Exception', 'OK', 'FAILED',
+                                                          'Reconciling', '  WriteBehindTest', 'The exit status')))
+
+    def test_write_behind(self):
+        "The differences are reported when the session finishes"
+        bond.spy('accepted', **self.run_tests('accept'))
+        bond.spy('same', **self.run_tests('abort', FINISH_SESSION='1'))
+        bond.spy('finish_session', **self.run_tests('abort', FINISH_SESSION='1', CHANGED='changed'))
+        bond.spy('at_exit', **self.run_tests('abort', CHANGED='changed'))
+        bond.spy('references', files=sorted(os.path.relpath(os.path.join(d, f), self.tmp_dir)
+                                            for d, _, fs in os.walk(self.tmp_dir) for f in fs if f.endswith('.json')))
+
+    def test_finisher(self):
+        "The worker counts the finished tests, and the mismatches, including errors"
+        finisher = bond_background.BackgroundFinisher()
+        finisher.submit('T.test_same', lambda: True)
+        finisher.submit('T.test_changed', lambda: False)
+        finisher.submit('T.test_error', lambda: 1 / 0)
+        finished, mismatches = finisher.join()
+        bond.spy('joined', finished=finished, mismatches=mismatches, joined_again=finisher.join())
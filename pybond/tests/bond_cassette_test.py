@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import setup_paths_test
+from bond import bond, bond_cassette
+from bond_test import setup_bond_self_test
+
+
+class CassetteTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+        self.cassette_dir = tempfile.mkdtemp()
+        self.real_calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cassette_dir)
+
+    @bond.spy_point(require_agent_result=True, spy_result=True)
+    def make_request(self, url, data=None):
+        self.real_calls.append(url)
+        return 200, 'response {} to {}'.format(len(self.real_calls), url)
+
+    @bond.spy_point(require_agent_result=True, include_keys=('url',), formatters=dict(url='truncate(8)'))
+    def post(self, url, body):
+        self.real_calls.append(url)
+        return 'posted {} to {}'.format(body, url)
+
+    def use_cassette(self, mode):
+        # We reach into the internal API, to keep the cassette out of the observation directory
+        bond.settings(cassette=mode)
+        bond.Bond.instance().cassette = bond_cassette.Cassette(os.path.join(self.cassette_dir,
+                                                                            'test.cassette.json'),
+                                                               mode)
+
+    def test_record_and_replay(self):
+        "Record the results of the real function, then replay them without invoking it"
+        self.use_cassette('record')
+        self.make_request('http://server/a')
+        self.make_request('http://server/a')
+        self.make_request('http://server/b', data='x')
+        bond.Bond.instance().cassette.save()
+        bond.spy('recorded', real_calls=self.real_calls)
+
+        self.real_calls = []
+        self.use_cassette('replay')
+        self.make_request('http://server/a')
+        self.make_request('http://server/a')
+        self.make_request('http://server/a')  # Replays the last result again
+        self.make_request('http://server/b', data='x')
+        bond.spy('replayed', real_calls=self.real_calls)
+
+    def test_projected_arguments(self):
+        "The calls are recorded and replayed on all their arguments, not on their observation"
+        self.use_cassette('record')
+        self.post('http://server/a', 1)
+        self.post('http://server/b', 1)
+        self.post('http://server/a', 2)
+        bond.Bond.instance().cassette.save()
+
+        self.real_calls = []
+        self.use_cassette('replay')
+        bond.spy('replayed', results=[self.post('http://server/b', 1), self.post('http://server/a', 2)],
+                 real_calls=self.real_calls)
+        self.assertRaises(AssertionError, lambda: self.post('http://server/b', 2))
+
+    def test_replay_missing(self):
+        "A call that is not in the cassette must still be mocked"
+        self.use_cassette('replay')
+        self.assertRaises(AssertionError, lambda: self.make_request('http://server/c'))
+
+    def test_agents_take_precedence(self):
+        "The agents are used before the cassette"
+        self.use_cassette('record')
+        bond.deploy_agent('CassetteTest.make_request', result=(404, 'mocked'))
+        self.make_request('http://server/a')
+        bond.spy('cassette', recordings=bond.Bond.instance().cassette.recordings)
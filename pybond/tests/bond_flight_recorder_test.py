@@ -0,0 +1,101 @@
+import os
+import signal
+import tempfile
+import unittest
+
+import setup_paths_test
+from bond import bond, bond_flight_recorder
+from bond_test import setup_bond_self_test
+
+
+class FlightRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+
+    def tearDown(self):
+        bond.stop_flight_recorder()
+
+    @bond.spy_point()
+    def annotated_method(self, arg1, *args, **kwargs):
+        return 'return value'
+
+    @bond.spy_point(enabled_for_groups='group1')
+    def annotated_method_group1(self, arg1):
+        return 'return value'
+
+    @bond.spy_point()
+    def annotated_method_failing(self, arg1):
+        raise ValueError('failing')
+
+    def outside_of_test(self, func):
+        """
+        Run func as if we were in production code, not in a test
+        """
+        bond_instance = bond.Bond.instance()
+        old_test_framework_bridge = bond_instance.test_framework_bridge
+        bond_instance.test_framework_bridge = None  # We reach into the internal API
+        try:
+            func()
+        finally:
+            bond_instance.test_framework_bridge = old_test_framework_bridge
+
+    def spy_records(self):
+        # We drop the time and the thread, which are not deterministic
+        records = bond_flight_recorder.recorder.records()
+        for rec in records:
+            del rec['time']
+            del rec['thread']
+        bond.spy('flight_recorder', records=records)
+
+    def test_record(self):
+        "The spy points record in the flight recorder outside of tests"
+        bond.start_flight_recorder(spy_groups='group2')
+
+        def production():
+            self.assertEqual('return value', self.annotated_method(1, 2, 3, arg4=4))
+            self.annotated_method_group1(1)  # Not recorded, group1 is not enabled
+            bond.spy('direct_spy', val=12)
+            self.assertRaises(ValueError, lambda: self.annotated_method_failing(2))
+        self.outside_of_test(production)
+        self.spy_records()
+
+    def test_ring_buffer(self):
+        "Only the most recent invocations are kept"
+        bond.start_flight_recorder(capacity=3)
+        self.outside_of_test(lambda: [self.annotated_method(i) for i in range(10)])
+        self.spy_records()
+
+    def test_snapshot(self):
+        "The records show the arguments at the time of the call, truncated"
+        bond.start_flight_recorder()
+        values = [1, 2]
+
+        def production():
+            self.annotated_method(values, 'x' * 300, (1, 'two', [3]), arg4=dict(a=1))
+            values.append(3)
+            bond.spy('direct_spy', values=values, big=range(100))
+        self.outside_of_test(production)
+        self.spy_records()
+
+    def test_dump(self):
+        "Dump the flight recorder on demand and on signal"
+        dump_file = os.path.join(tempfile.mkdtemp(), 'flight_recorder.json')
+        bond.start_flight_recorder(dump_file=dump_file, dump_on_signal=signal.SIGUSR1)
+        self.outside_of_test(lambda: self.annotated_method('first'))
+        os.kill(os.getpid(), signal.SIGUSR1)
+        with open(dump_file, 'r') as f:
+            bond.spy('dump_on_signal', nr_lines=len(f.readlines()))
+
+        self.outside_of_test(lambda: self.annotated_method('second'))
+        self.assertEqual(dump_file, bond.dump_flight_recorder())
+        with open(dump_file, 'r') as f:
+            bond.spy('dump_on_demand', nr_lines=len(f.readlines()))
+        os.unlink(dump_file)
+        os.rmdir(os.path.dirname(dump_file))
+
+    def test_not_started(self):
+        "Nothing is recorded without a flight recorder"
+        self.outside_of_test(lambda: self.annotated_method(1))
+        self.assertIsNone(bond.dump_flight_recorder())
+
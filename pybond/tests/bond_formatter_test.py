@@ -1,28 +1,64 @@
-import os
-import shutil
 import unittest
-import re
 
 import setup_paths_test
 from bond import bond
+from bond.bond_helpers import format_at, Rewritter
+from bond.bond_helpers.format_at import value_formatter
 
-from bond import bond_reconcile
-from bond.bond_helpers import format_at
+from bond_test import setup_bond_self_test
 
-from bond_test import setup_bond_self_test, teardown_bond_self_test
 
-class FormatterTest(unittest.TestCase):
+def bus_data():
+    return dict(route='Berkeley Hills',
+                buses=[dict(id=1, lat=37.8715926, lon=-122.272747, away=True, driver=dict(name='Ann')),
+                       dict(id=2, lat=37.8695421, lon=-122.259411, away=False, driver=dict(name='Bob'))],
+                message='line 1\nline 2\nline 3',
+                auth=dict(user='bond', password='secret', token=dict(password='secret too')))
+
 
-    @bond.spy_point()
-    def annotated_standard_method(self, arg1, arg2):
-        return 'return value'
+class FormatterTest(unittest.TestCase):
 
     def setUp(self):
-        self.testing_observation_dir = '/tmp/bondObservations Dir'  # Intentionally put a space in the path
-        self.reference_file = os.path.join(self.testing_observation_dir, 'reference.json')
-        self.current_file = os.path.join(self.testing_observation_dir, 'reference_now.json')
+        setup_bond_self_test(self, ())
+
+    def test_agent_formatter(self):
+        "A format_at formatter used as an agent formatter"
+        bond.deploy_agent('get_buses',
+                          formatter=format_at('response.route').replace_str('Berkeley', 'B.').truncate(6))
+        bond.spy('get_buses', response=bus_data())
 
-        self.reference_file_content = ""
+    def test_rewritter(self):
+        "Several formatters applied in one traversal"
+        bond.deploy_agent('get_buses',
+                          formatter=Rewritter(format_at('response.buses[*].lat').round(2),
+                                              format_at('response.buses[*].lon').round(1),
+                                              format_at('response.buses[*].away').drop(),
+                                              format_at('response.message').split()))
+        bond.spy('get_buses', response=bus_data())
 
+    def test_selectors(self):
+        "Wildcards, deep selectors and list indices"
+        obs = bus_data()
+        Rewritter(format_at('**.password').hash(),
+                  format_at('buses[0]').drop(),
+                  format_at('buses.*.driver.name').apply(lambda name: name.upper()),
+                  format_at('*.user').replace_re('[aeiou]', '_'),
+                  format_at('lost.key').drop())(obs)
+        bond.spy('selected', obs=obs)
 
+    def test_invalid_selector(self):
+        "Selectors are checked when the formatter is created"
+        self.assertRaises(AssertionError, format_at, 'buses[x]')
 
+    def test_value_formatter(self):
+        "The specs of the formatters for one value"
+        value = 'The quick brown fox'
+        bond.spy('formatted',
+                 len=value_formatter('len')(value),
+                 hash=value_formatter('hash')(value),
+                 truncate=value_formatter('truncate(9)')(value),
+                 round=value_formatter(' round( 2 ) ')(3.14159),
+                 split=value_formatter('split')('line 1\nline 2'),
+                 chain=value_formatter(['split(" ")', 'truncate(2)', len])(value),
+                 replace=value_formatter('replace_re("[aeiou]", "_")')(value))
+        self.assertRaises(AssertionError, value_formatter, 'unknown(2)')
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import setup_paths_test
+from bond import bond, bond_memoize
+from bond_test import setup_bond_self_test
+
+
+# The number of times the real functions were invoked
+real_calls = []
+
+
+@bond.spy_point(memoize=True, spy_result=True)
+def expensive_parse(text, factor=1):
+    real_calls.append(text)
+    return dict(words=text.split(), factor=factor)
+
+
+@bond.spy_point(memoize=True, formatters=dict(text='truncate(3)'))
+def truncated_parse(text):
+    real_calls.append(text)
+    return text.upper()
+
+
+@bond.spy_point(memoize=True)
+def make_counter(start):
+    real_calls.append(start)
+    return (start + i for i in range(3))
+
+
+class MemoizeTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+        del real_calls[:]
+
+    def test_memoize(self):
+        "The results are memoized, and the cache hits are still observed"
+        expensive_parse('memoize test one two')
+        result = expensive_parse('memoize test one two')
+        result['words'].append('changed')  # Must not change the memoized result
+        expensive_parse('memoize test one two')
+        expensive_parse('memoize test one two', factor=2)
+        bond.spy('real_calls', real_calls=real_calls)
+
+    def test_memoize_formatted_arguments(self):
+        "The results are memoized on the arguments, not on their formatted observation"
+        bond.spy('results', results=[truncated_parse('abcdef'), truncated_parse('abcxyz'), truncated_parse('abcdef')],
+                 real_calls=real_calls)
+
+    def test_unpicklable_result(self):
+        "The results that cannot be pickled are not memoized"
+        bond.spy('results', first=list(make_counter(1)), second=list(make_counter(1)), real_calls=real_calls)
+
+    def test_agents_take_precedence(self):
+        "The memoized result is not used when an agent provides the result"
+        bond.deploy_agent('bond_memoize_test.expensive_parse', result='mocked')
+        expensive_parse('agents test')
+        bond.spy('real_calls', real_calls=real_calls)
+
+    def test_memo_key(self):
+        "The key depends on the exact arguments and on the source of the function"
+        keys = [bond_memoize.memo_key('point', 'hash1', dict(x=1.00001), repr),
+                bond_memoize.memo_key('point', 'hash1', dict(x=1.00002), repr),
+                bond_memoize.memo_key('point', 'hash2', dict(x=1.00001), repr)]
+        bond.spy('keys', keys=keys)
+
+    def test_memory_lru(self):
+        "The in-memory cache evicts the least recently used results"
+        cache = bond_memoize.MemoCache(max_size=100)
+        cache.put('a', 'a' * 30)
+        cache.put('b', 'b' * 30)
+        cache.get('a')
+        cache.put('c', 'c' * 30)  # Evicts 'b'
+        bond.spy('cache', keys=cache.entries.keys())
+
+    def test_disk_lru(self):
+        "The on-disk store evicts the least recently used results"
+        directory = tempfile.mkdtemp()
+        try:
+            cache = bond_memoize.DiskMemoCache(directory, max_size=100)
+            cache.put_pickled('a', 'a' * 40)
+            os.utime(cache._file_name('a'), (1, 1))
+            cache.put_pickled('b', 'b' * 40)
+            cache.put_pickled('c', 'c' * 40)  # Evicts 'a'
+            reopened = bond_memoize.DiskMemoCache(directory, max_size=100)
+            bond.spy('disk_cache',
+                     a=reopened.get_pickled('a'),
+                     b=reopened.get_pickled('b'),
+                     size=reopened.size)
+        finally:
+            shutil.rmtree(directory)
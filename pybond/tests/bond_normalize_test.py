@@ -0,0 +1,51 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+import setup_paths_test
+from bond import bond
+from bond_test import setup_bond_self_test
+
+
+class Widget:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<Widget {} at {}>'.format(self.name, hex(id(self)))
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+
+    def test_standard_rules(self):
+        "The standard rules, with the distinct values numbered in order"
+        bond.settings(normalizers=['address', 'tmp_file', 'timestamp', 'pid'])
+        w1 = Widget('one')
+        w2 = Widget('two')
+        fd, tmp_file = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(tmp_file)
+        bond.spy('widgets', first=repr(w1), second=repr(w2), again=repr(w1))
+        bond.spy('files', tmp_file=tmp_file, message='Opened {} in pid={}'.format(tmp_file, os.getpid()))
+        bond.spy('times', now=datetime.datetime.now().isoformat(), pid=os.getpid())
+
+    def test_custom_rules(self):
+        "Regular expression and type rules, with string and function replacements"
+        bond.settings(normalizers=[(r'session=\w+', 'session={n}'),
+                                   (r'\d+ms', lambda text: '<duration>'),
+                                   (Widget, lambda w: '<Widget {}>'.format(w.name)),
+                                   (datetime.datetime, '<datetime>')])
+        bond.spy('custom',
+                 url='/get?session=a81fx2&other=session=a81fx2',
+                 url2='/get?session=kk00',
+                 log='took 153ms, then 17ms',
+                 widget=Widget('main'),
+                 when=datetime.datetime.now())
+
+    def test_invalid_rule(self):
+        "Unknown standard rules are rejected by settings"
+        self.assertRaises(AssertionError, bond.settings, normalizers=['no_such_rule'])
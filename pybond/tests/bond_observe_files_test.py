@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import setup_paths_test
+from bond import bond
+from bond.bond_helpers import collect_directory_contents, DirectorySnapshot, observe_files
+from bond_test import setup_bond_self_test
+
+
+class ObserveFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'subdir', 'empty_subdir'))
+        self.write_file('file1.txt', 'line 1\nline 2  \n')
+        self.write_file('file2.log', 'no newline at end')
+        self.write_file('empty.txt', '')
+        self.write_file(os.path.join('subdir', 'file3.txt'), 'line 1\r\n\nline 3\n')
+
+        self.saved_scandir = observe_files._scandir
+        self.saved_large_file_size = observe_files.LARGE_FILE_SIZE
+        self.saved_parallel_read_min_files = observe_files.PARALLEL_READ_MIN_FILES
+        self.saved_read_file = observe_files._read_file
+
+    def tearDown(self):
+        observe_files._scandir = self.saved_scandir
+        observe_files.LARGE_FILE_SIZE = self.saved_large_file_size
+        observe_files.PARALLEL_READ_MIN_FILES = self.saved_parallel_read_min_files
+        observe_files._read_file = self.saved_read_file
+        shutil.rmtree(self.directory)
+
+    def write_file(self, rel_file, content):
+        with open(os.path.join(self.directory, rel_file), 'w') as f:
+            f.write(content)
+
+    def test_collect_lines(self):
+        "Collect the directory with the file contents"
+        bond.spy('contents',
+                 all=collect_directory_contents(self.directory,
+                                                collect_file_contents=True),
+                 only_txt=collect_directory_contents(self.directory,
+                                                     collect_file_contents=r'.*\.txt'),
+                 filtered=collect_directory_contents(self.directory,
+                                                     file_filter=r'(subdir|file1)'))
+
+    def test_collect_without_scandir(self):
+        "The results are the same with listdir and with scandir, and with parallel reads"
+        with_scandir = collect_directory_contents(self.directory, collect_file_contents=True)
+        observe_files._scandir = None
+        observe_files.PARALLEL_READ_MIN_FILES = 2
+        self.assertEqual(with_scandir,
+                         collect_directory_contents(self.directory, collect_file_contents=True))
+
+    def test_collect_digest(self):
+        "Collect the size and hash of the files"
+        digests = collect_directory_contents(self.directory,
+                                             collect_file_contents=True,
+                                             content_mode='digest')
+        observe_files.LARGE_FILE_SIZE = 1
+        self.assertEqual(digests,
+                         collect_directory_contents(self.directory,
+                                                    collect_file_contents=True,
+                                                    content_mode='digest'))
+        bond.spy('digests', digests=digests)
+
+    def test_snapshot(self):
+        "Snapshots re-read only the changed files, and can observe the delta"
+        files_read = []
+
+        def counting_read_file(file):
+            files_read.append(os.path.relpath(file, self.directory))
+            return self.saved_read_file(file)
+        observe_files._read_file = counting_read_file
+
+        snapshot = DirectorySnapshot(self.directory, collect_file_contents=r'.*\.txt')
+        bond.spy('first_snapshot', tree=snapshot.collect(), files_read=sorted(files_read))
+
+        del files_read[:]
+        self.write_file('file1.txt', 'line 1 changed\n')
+        os.utime(os.path.join(self.directory, 'file1.txt'), (1, 1))
+        os.utime(os.path.join(self.directory, 'file2.log'), (2, 2))
+        os.unlink(os.path.join(self.directory, 'empty.txt'))
+        self.write_file(os.path.join('subdir', 'file4.txt'), 'new file')
+        bond.spy('delta', delta=snapshot.delta(), files_read=sorted(files_read))
+
+        del files_read[:]
+        os.utime(os.path.join(self.directory, 'subdir', 'file3.txt'), (3, 3))  # Same contents
+        bond.spy('delta_unchanged_contents', delta=snapshot.delta(), files_read=sorted(files_read))
+        self.assertEqual(collect_directory_contents(self.directory, collect_file_contents=r'.*\.txt'),
+                         snapshot.collect())
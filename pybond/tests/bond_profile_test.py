@@ -0,0 +1,99 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import setup_paths_test
+from bond import bond, bond_profile
+from bond_test import setup_bond_self_test
+
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+        bond.settings(profile=True)
+
+    @bond.spy_point()
+    def annotated_method(self, arg1):
+        return arg1 + 1
+
+    def test_profile_counts(self):
+        "The call counts are collected per spy point, separately from the observations"
+        self.annotated_method(1)
+        self.annotated_method(2)
+        bond.deploy_agent('ProfileTest.annotated_method', arg1=3, result=100)
+        self.annotated_method(3)
+        profiler = bond.Bond.instance().profiler
+        bond.spy('profile_counts', counts=profiler.counts())
+
+        self.assertEqual(2, profiler.spy_points['ProfileTest.annotated_method'].runs)
+        report = profiler.report('test')
+        self.assertIn('ProfileTest.annotated_method', report)
+        self.assertIn('<bond deepcopy>', report)
+
+    def test_profile_spy_many(self):
+        "Each row of a batch is counted once, also when an agent makes us spy the rows one by one"
+        bond.spy_many('batch', [dict(id=1), dict(id=2)])
+        bond.deploy_agent('agent_batch', id=1, result='mocked')
+        bond.spy_many('agent_batch', [dict(id=1), dict(id=2)])
+        bond.spy('profile_counts', counts=bond.Bond.instance().profiler.counts())
+
+    def test_profile_disabled(self):
+        "The profiler can be turned off"
+        bond.settings(profile=False)
+        self.annotated_method(1)
+        self.assertIsNone(bond.Bond.instance().profiler)
+
+    def test_profile_merge(self):
+        "The session profiler aggregates the per-test profilers"
+        profiler1 = bond_profile.SpyProfiler()
+        profiler1.record_spy('point')
+        profiler1.record_run('point', 0.002)
+        profiler2 = bond_profile.SpyProfiler()
+        profiler2.record_spy('point')
+        profiler2.record_run('point', 0.5)
+        profiler1.merge(profiler2)
+        stats = profiler1.spy_points['point']
+        bond.spy('merged',
+                 counts=profiler1.counts(),
+                 histogram=stats.histogram_str(),
+                 max_time=stats.max_time)
+
+
+class TraceTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+        bond.settings(trace=True)
+
+    @bond.spy_point()
+    def outer_method(self, arg1):
+        return self.inner_method(arg1) + 1
+
+    @bond.spy_point()
+    def inner_method(self, arg1):
+        bond.spy('inside', arg1=arg1)
+        return arg1 * 2
+
+    def test_trace_nesting(self):
+        "The trace events nest following the call stack"
+        self.outer_method(5)
+        tracer = bond.Bond.instance().tracer
+        bond.spy('trace_events',
+                 events=[(e['name'], e['ph']) for e in tracer.events])
+
+    def test_trace_save(self):
+        "The trace is saved in the Chrome trace-event format"
+        self.outer_method(1)
+        trace_file = os.path.join(tempfile.mkdtemp(), 'test.trace.json')
+        bond.Bond.instance().tracer.save(trace_file)
+        with open(trace_file, 'r') as f:
+            trace = json.load(f)
+        shutil.rmtree(os.path.dirname(trace_file))
+        bond.spy('saved_trace',
+                 keys=sorted(trace.keys()),
+                 event_keys=sorted(trace['traceEvents'][0].keys()),
+                 timestamps_ordered=all(e1['ts'] <= e2['ts'] for e1, e2 in zip(trace['traceEvents'],
+                                                                               trace['traceEvents'][1:])))
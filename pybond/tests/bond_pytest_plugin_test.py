@@ -0,0 +1,135 @@
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import setup_paths_test
+from bond import bond
+from bond_test import setup_bond_self_test
+
+try:
+    import xdist
+except ImportError:
+    xdist = None
+
+
+_CONFTEST = '''
+pytest_plugins = ['bond.pytest_plugin']
+'''
+
+# A test module with the kinds of tests that the plugin supports
+_TEST_MODULE = '''
+import os
+import unittest
+import pytest
+from bond import bond as bond_module
+from bond.bond_helpers import VirtualClock
+
+
+def changed(value):
+    return value + os.environ.get('CHANGED', '')
+
+
+def test_function(bond):
+    bond.spy('function', value=changed('f'))
+
+
+def test_virtual_clock(bond):
+    # Registers another callback for the end of the test
+    VirtualClock().deploy(patch_time=True)
+    bond.spy('virtual_clock', value=changed('v'))
+
+
+@pytest.mark.parametrize('n', [1, 2, 3])
+def test_parametrized(bond, n):
+    bond.spy('parametrized', n=n)
+
+
+def test_fails(bond):
+    bond.spy('before_failure', value=changed('x'))
+    assert False, 'Test failure'
+
+
+class TestClass:
+    def test_method(self, bond):
+        bond.spy('method', value=changed('m'))
+
+
+class UnittestTest(unittest.TestCase):
+    def setUp(self):
+        bond_module.start_test(self)
+
+    def test_unittest(self):
+        bond_module.spy('unittest', value=changed('u'))
+'''
+
+
+@unittest.skipIf(xdist is None, 'The pytest plugin tests require pytest-xdist')
+class PytestPluginTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_tests(self, name):
+        "Make a directory with the test module, and return it"
+        test_dir = os.path.join(self.tmp_dir, name)
+        os.makedirs(test_dir)
+        with open(os.path.join(test_dir, 'conftest.py'), 'w') as f:
+            f.write(_CONFTEST)
+        with open(os.path.join(test_dir, 'test_example.py'), 'w') as f:
+            f.write(_TEST_MODULE)
+        return test_dir
+
+    def run_pytest(self, test_dir, reconcile, *args, **env):
+        "Run pytest in a separate process, and return its exit status and outcome"
+        env = dict(os.environ, BOND_RECONCILE=reconcile,
+                   PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(bond.__file__))),
+                   **env)
+        process = subprocess.Popen([sys.executable, '-m', 'pytest', '-p', 'no:cacheprovider', '-rf'] + list(args),
+                                   cwd=test_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        summary = re.search(r'=+ ([^=]*) in [\d.]+ seconds', output)
+        return dict(exit_status=process.returncode,
+                    summary=summary.group(1) if summary else output,
+                    failed=sorted(re.findall(r'^FAILED (\S+)', output, re.MULTILINE)))
+
+    def references(self, test_dir):
+        "The reference observations saved in the test directory"
+        observation_dir = os.path.join(test_dir, 'test_observations')
+        res = {}
+        for dir_name, _, file_names in os.walk(observation_dir):
+            for file_name in file_names:
+                with open(os.path.join(dir_name, file_name)) as f:
+                    res[os.path.relpath(os.path.join(dir_name, file_name), observation_dir)] = f.read()
+        return res
+
+    def test_serial(self):
+        "Run the tests in one process, with the failures detected from the pytest reports"
+        test_dir = self.make_tests('serial')
+        bond.spy('accept', **self.run_pytest(test_dir, 'accept'))
+        bond.spy('references', files=sorted(self.references(test_dir)))
+        bond.spy('abort', **self.run_pytest(test_dir, 'abort'))
+        bond.spy('changed', **self.run_pytest(test_dir, 'abort', CHANGED='_changed'))
+
+    def test_xdist(self):
+        "Run the tests on several workers, with the same references as in a serial run"
+        serial_dir = self.make_tests('serial')
+        xdist_dir = self.make_tests('xdist')
+        self.run_pytest(serial_dir, 'accept')
+        bond.spy('accept', **self.run_pytest(xdist_dir, 'accept', '-n', '2'))
+        bond.spy('same_as_serial', same=(self.references(serial_dir) == self.references(xdist_dir)))
+
+        bond.spy('abort', **self.run_pytest(xdist_dir, 'abort', '-n', '2', CHANGED='_changed'))
+        bond.spy('not_saved', same=(self.references(serial_dir) == self.references(xdist_dir)))
+
+        # The reconcile on the controller
+        self.run_pytest(serial_dir, 'accept', CHANGED='_changed')
+        bond.spy('accept_changed', **self.run_pytest(xdist_dir, 'accept', '-n', '2', CHANGED='_changed'))
+        bond.spy('same_as_serial_changed', same=(self.references(serial_dir) == self.references(xdist_dir)))
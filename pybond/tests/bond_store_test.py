@@ -0,0 +1,170 @@
+import bz2
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import setup_paths_test
+from bond import bond, bond_reconcile, bond_store
+from bond_test import setup_bond_self_test
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sqlite_store(self):
+        "Reading, writing and matching references in a database, with batched writes"
+        store = bond_store.SqliteStore(os.path.join(self.tmp_dir, 'obs.sqlite'), batch_size=2)
+        store.write('T.test_one', ['[\n', ']\n'])
+        bond.spy('pending', read=store.read('T.test_one'), pending=sorted(store.pending),
+                 matches=store.matches('T.test_one', ['[\n', ']\n']))
+        store.write('T.test_two', ['[\n', '{}\n', ']\n'])
+        bond.spy('batch_saved', pending=sorted(store.pending), test_names=store.test_names())
+
+        # A new connection sees the saved references
+        store = bond_store.SqliteStore(os.path.join(self.tmp_dir, 'obs.sqlite'))
+        bond.spy('reopened',
+                 read=store.read('T.test_two'),
+                 missing=store.read('T.test_three'),
+                 matches=store.matches('T.test_two', ['[\n', '{}\n', ']\n']),
+                 differs=store.matches('T.test_two', ['[\n', ']\n']))
+
+    def test_reconcile_with_store(self):
+        "Reconcile against the references in a store"
+        store = bond_store.SqliteStore(os.path.join(self.tmp_dir, 'obs.sqlite'))
+        current_lines = ['[\n', '{}\n', ']\n']
+        accepted = bond_reconcile.reconcile_observations(dict(reconcile='accept'), 'T.test', 'unused',
+                                                         current_lines, store=store)
+        same = bond_reconcile.reconcile_observations(dict(reconcile='abort'), 'T.test', 'unused',
+                                                     current_lines, store=store)
+        different = bond_reconcile.reconcile_observations(dict(reconcile='abort'), 'T.test', 'unused',
+                                                          ['[\n', ']\n'], store=store)
+        bond.spy('reconciled', accepted=accepted, same=same, different=different,
+                 reference=store.read('T.test'))
+
+    def test_export_import(self):
+        "Export the references to the file layout, and import them back"
+        database_file = os.path.join(self.tmp_dir, bond_store.SQLITE_DATABASE)
+        store = bond_store.SqliteStore(database_file)
+        store.write('T.test_one', ['[\n', ']\n'])
+        store.write('Other.T.test_two', ['[\n', '{}\n', ']\n'])
+        store.flush()
+
+        script = os.path.join(os.path.dirname(bond_store.__file__), 'bond_store.py')
+        output = subprocess.check_output([sys.executable, script, 'export',
+                                          '--observation-directory', self.tmp_dir])
+        file_store = bond_store.FileStore(self.tmp_dir)
+        exported = dict((t, file_store.read(t)) for t in file_store.test_names())
+        os.unlink(database_file)
+
+        file_store.write('T.test_three', ['[\n', ']\n'])
+        import_output = subprocess.check_output([sys.executable, script, 'import',
+                                                 '--observation-directory', self.tmp_dir])
+        bond.spy('exported', output=output, exported=exported,
+                 files=sorted(os.path.relpath(os.path.join(d, f), self.tmp_dir)
+                              for d, _, fs in os.walk(self.tmp_dir) for f in fs if f.endswith('.json')))
+        bond.spy('imported', output=import_output,
+                 test_names=bond_store.SqliteStore(database_file).test_names())
+
+    def test_compressed_files(self):
+        "References above the threshold are compressed, and compressed references are read as text"
+        store = bond_store.FileStore(self.tmp_dir, compress_threshold=20)
+        small_lines = ['[\n', ']\n']
+        large_lines = ['[\n'] + ['{"__spy_point__": "repeated"},\n'] * 100 + [']\n']
+        store.write('T.test_small', small_lines)
+        store.write('T.test_large', small_lines)
+        store.write('T.test_large', large_lines)
+        with open(store.location('T.test_large'), 'rb') as f:
+            compressed = f.read()
+        store.write('T.test_large', large_lines)
+        with open(store.location('T.test_large'), 'rb') as f:
+            same_compressed = f.read() == compressed
+
+        bz2_file = bz2.BZ2File(os.path.join(self.tmp_dir, 'T', 'test_bz2.json.bz2'), 'wb')
+        bz2_file.writelines(small_lines)
+        bz2_file.close()
+
+        bond.spy('compressed',
+                 files=sorted(os.listdir(os.path.join(self.tmp_dir, 'T'))),
+                 smaller=len(compressed) < len(''.join(large_lines)),
+                 same_compressed=same_compressed,
+                 read_large=store.read('T.test_large') == large_lines,
+                 read_bz2=store.read('T.test_bz2'),
+                 matches=store.matches('T.test_large', large_lines),
+                 prefix_differs=store.matches('T.test_large', large_lines[0:-1]),
+                 longer_differs=store.matches('T.test_large', large_lines + [']\n']),
+                 test_names=store.test_names())
+
+        # Reconcile directly against a compressed reference file
+        reference_file = store.location('T.test_large')
+        same = bond_reconcile.reconcile_observations(dict(reconcile='abort'), 'T.test_large', reference_file,
+                                                     large_lines)
+        accepted = bond_reconcile.reconcile_observations(dict(reconcile='accept'), 'T.test_large', reference_file,
+                                                         small_lines)
+        bond.spy('reconciled', same=same, accepted=accepted, read=store.read('T.test_large'))
+
+    def test_shared_stores(self):
+        "The stores are shared by the sessions with the same settings, and their settings do not change"
+        compressed = bond_store.reference_store(bond_store.FILES, self.tmp_dir, compress_threshold=20)
+        plain = bond_store.reference_store(bond_store.FILES, self.tmp_dir)
+        bond.spy('stores',
+                 shared=compressed is bond_store.reference_store(bond_store.FILES, self.tmp_dir, compress_threshold=20),
+                 distinct=compressed is not plain,
+                 thresholds=[compressed.compress_threshold, plain.compress_threshold])
+
+    def prefetch_stats_since(self, before, keys=('requests', 'misses', 'unused')):
+        after = bond_store.prefetch_stats()
+        return dict((k, after[k] - before[k]) for k in keys)
+
+    def test_prefetch(self):
+        "Prefetched references are read, and compared, from memory"
+        store = bond_store.FileStore(self.tmp_dir, compress_threshold=20)
+        large_lines = ['[\n'] + ['{"__spy_point__": "repeated"},\n'] * 100 + [']\n']
+        store.write('T.test_large', large_lines)
+        # The same whether Bond prefetches the reference for this test or not
+        bond.settings(prefetch=True)
+        before = bond_store.prefetch_stats()
+        store.prefetch('T.test_large')
+        matches = store.matches('T.test_large', large_lines)
+        read = store.read('T.test_large')
+        after = bond_store.prefetch_stats()
+        bond.spy('prefetched', matches=matches, read_same=(read == large_lines),
+                 differs=store.matches('T.test_large', large_lines[0:-1]),
+                 ready=(after['hits'] + after['waits']) - (before['hits'] + before['waits']),
+                 stats=self.prefetch_stats_since(before))
+
+        # A write drops the prefetched reference
+        store.write('T.test_large', ['[\n', ']\n'])
+        bond.spy('after_write', read=store.read('T.test_large'), stats=self.prefetch_stats_since(before))
+
+        # A prefetched reference that is not used, and a missing reference
+        store.prefetch('T.test_other')
+        store.prefetch('T.test_missing')
+        bond.spy('missing', read=store.read('T.test_missing'), matches=store.matches('T.test_missing', ['[\n', ']\n']),
+                 stats=self.prefetch_stats_since(before))
+
+    def test_prefetch_after_test(self):
+        "Changing the settings after a test ended does not prefetch the reference of that test"
+        session = bond.Bond()
+        session.test_name = 'T.test_ended'  # As the test name is left after the test ends
+        before = bond_store.prefetch_stats()
+        session.settings(prefetch=True)
+        bond.spy('after_test', stats=self.prefetch_stats_since(before, keys=('requests', 'misses')))
+
+    def test_prefetch_setting(self):
+        "Bond prefetches the reference when the test starts, and again when its location changes"
+        observation_directory = bond.Bond.instance()._settings['observation_directory']
+        before = bond_store.prefetch_stats()
+        bond.settings(prefetch=True)
+        bond.spy('prefetching', stats=self.prefetch_stats_since(before, keys=('requests', 'misses')))
+        bond.settings(observation_directory=self.tmp_dir)
+        bond.spy('moved', stats=self.prefetch_stats_since(before, keys=('requests', 'misses')))
+        bond.settings(observation_directory=observation_directory)
@@ -0,0 +1,49 @@
+import json
+import unittest
+
+import setup_paths_test
+from bond import bond, bond_table
+from bond_test import setup_bond_self_test, spied_observation_lines
+
+
+BUSES = [dict(id=3, lat=41.8781136, lon=-87.6297982, away=False, driver=None),
+         dict(id=1, lat=41.881832, lon=-87.623177, away=True, driver=None),
+         dict(id=2, lat=41.8, lon=-87.6, away=False, driver='Jo')]
+
+
+class TableTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+
+    def test_spy_table(self):
+        "The rows of a table are saved on one line each"
+        bond.settings(decimal_precision=3)
+        bond.spy_table('buses', BUSES, sort_key='id', count=len(BUSES))
+        bond.spy_table('buses', BUSES, columns=['away', 'id'], sort_key=lambda row: (row['away'], -row['id']))
+        bond.spy_table('pairs', [(i % 2, [i, {}], dict(a=i)) for i in range(4)],
+                       columns=['parity', 'nested', 'dict'], sort_key=['parity'])
+        bond.spy_table('empty', [], columns=['a'])
+
+    def test_lines(self):
+        "The lines for tables are valid JSON"
+        _, lines = spied_observation_lines(lambda: bond.spy_table('buses', BUSES, sort_key='id'))
+        bond.spy('lines',
+                 parsed=json.loads(''.join(lines))[0][bond_table.TABLE_KEY],
+                 line_count=len(lines))
+
+    def test_table_differences(self):
+        "The differences in tables are described row by row"
+        def spy(buses, columns=None):
+            bond.spy('before', val=1)
+            bond.spy_table('buses', buses, columns=columns, sort_key='id')
+            bond.spy_table('other', [dict(a=1)])
+            bond.spy_table('buses', buses[0:1], columns=columns)
+
+        _, reference_lines = spied_observation_lines(lambda: spy(BUSES))
+        changed = [dict(BUSES[0], lat=41.9), BUSES[1], dict(id=4, lat=41.7, lon=-87.5, away=True, driver='Al')]
+        bond.spy('changed', differences=bond_table.table_differences(reference_lines,
+                                                                     spied_observation_lines(lambda: spy(changed))[1]))
+        bond.spy('columns', differences=bond_table.table_differences(
+            reference_lines, spied_observation_lines(lambda: spy(BUSES, columns=['id', 'lat', 'speed']))[1]))
+        bond.spy('same', differences=bond_table.table_differences(reference_lines, reference_lines))
@@ -1,6 +1,10 @@
 import unittest
+import json
 import os
 import shutil
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
 import setup_paths_test
 from bond import bond, bond_helpers
@@ -42,6 +46,22 @@ def setup_bond_self_test(test_instance, spy_groups=None):
     bond.deploy_agent('bond_reconcile._read_console',
                       result=bond.AGENT_RESULT_CONTINUE)
 
+
+def spied_observation_lines(spy):
+    """
+    Call spy with the observations of the current test set aside
+    :return: the result of spy, and the lines that Bond would save for the observations that it made
+    """
+    the_bond = bond.Bond.instance()
+    saved = (the_bond.observations, the_bond.observation_repeats, the_bond.last_observation)
+    the_bond.observations, the_bond.observation_repeats, the_bond.last_observation = [], {}, None
+    try:
+        result = spy()
+        return result, the_bond._get_observations()
+    finally:
+        the_bond.observations, the_bond.observation_repeats, the_bond.last_observation = saved
+
+
 def teardown_bond_self_test(test_instance):
     test_instance.during_test = False
     # Change the settings to use a console reconcile for the end of the test
@@ -63,6 +83,14 @@ class BondTest(unittest.TestCase):
                  dict_arg=dict(foo=1, bar=2))
         bond.spy('there', val=10)
 
+    def test_spy_nested(self):
+        "Nested and empty containers, and strings with separators and brackets"
+        bond.spy('nested',
+                 empty_list=[],
+                 empty_dict={},
+                 nested=[[], [{}], dict(a=[1, [2, {}]], b=dict(c=None))],
+                 tricky_string='a, [b]: {c}, "d" \\',
+                 tricky_key={'a, b": [': '}'})
 
 
     def test_spy_named(self):
@@ -111,6 +139,7 @@ class BondTest(unittest.TestCase):
         self.assertFalse(bond.active())
         bond.spy('first_observation', val=1)
         bond.spy('second_observation', val=2)
+        self.assertEqual(None, bond.spy_many('third_observation', [dict(val=3)]))
 
         # Just before the test ends, we restore current_python_test
         bond_instance.test_framework_bridge = old_test_framework_bridge  # Has to allow the test to continue
@@ -236,11 +265,145 @@ class BondTest(unittest.TestCase):
         self.annotated_method_group_enabled()
         self.annotated_method_no_group()
 
+    def test_collapse_repeats(self):
+        "Consecutive identical observations are collapsed"
+        bond.settings(collapse_repeats=True)
+        for i in range(5):
+            bond.spy('sleep', seconds=60)
+        bond.spy('check', value=1)
+        bond.spy('check', value=1)
+        bond.spy('check', value=2)
+        bond.spy('sleep', seconds=60)
+        bond.spy()
+        bond.spy()
+
+    def test_collapse_repeats_agent(self):
+        "Collapse the repeats for only one spy point, with a formatter"
+        bond.deploy_agent('sleep', collapse_repeats=True,
+                          formatter=lambda obs: obs.update(seconds=str(obs['seconds'])))
+        for i in range(3):
+            bond.spy('sleep', seconds=60)
+            bond.spy('sleep', seconds=60)
+            bond.spy('check', value=1)
+            bond.spy('check', value=1)
+
+    def test_spy_many(self):
+        "A batch of observations is recorded as with one spy for each row"
+        bond.settings(collapse_repeats=True, decimal_precision=2)
+        bond.deploy_agent('bus', id=2, result=lambda obs: obs['id'] * 10,
+                          formatter=lambda obs: obs.update(lat='<lat>'))
+        rows = [dict(id=i % 3, lat=i / 3.0, stops=[{}, 'stop']) for i in range(5)] + [dict(id=5, lat=0.5)] * 3
+        single_results, single = spied_observation_lines(
+            lambda: [bond.spy('bus', **row) for row in rows] + [[bond.spy('trip', **row) for row in rows]])
+        many_results, many = spied_observation_lines(
+            lambda: bond.spy_many('bus', rows) + [bond.spy_many('trip', iter(rows))])
+        bond.spy('compare', same=(single == many), same_results=(single_results == many_results),
+                 results=many_results)
+        bond.spy_many('trip', rows[0:3])
+        bond.spy_many('trip', [])
+
+    def test_unordered(self):
+        "The observations from a pool of threads, in an unordered region"
+        pool = ThreadPool(4)
+        try:
+            bond.spy('before', val=0)
+            with bond.unordered():
+                pool.map(lambda i: bond.spy('worker', item=i, square=i * i), range(20, 0, -1))
+                with bond.unordered():
+                    bond.spy('nested', val=2)
+                    bond.spy('nested', val=1)
+            bond.spy('after', val=0)
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_unordered_repeats(self):
+        "Collapsed observations keep their repeat count when they are sorted"
+        bond.settings(collapse_repeats=True)
+        with bond.unordered():
+            bond.spy('b', val=1)
+            bond.spy('b', val=1)
+            bond.spy('a', val=1)
+        bond.spy('a', val=1)
+
+    def test_concurrent_sessions(self):
+        "Tests that run concurrently, each in its own thread with its own session"
+        observation_directory = tempfile.mkdtemp()
+        try:
+            turns = TurnTaking(['first', 'second'])
+            result = unittest.TestResult()
+
+            def run_in_session(test):
+                with bond.bind_session():
+                    test.run(result)
+            threads = [threading.Thread(target=run_in_session,
+                                        args=(ConcurrentTest(name, precision, observation_directory, turns),))
+                       for name, precision in (('first', 2), ('second', 5))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            references = {}
+            for name in ('first', 'second'):
+                with open(os.path.join(observation_directory, 'Concurrent', name + '.json')) as f:
+                    references[name] = f.read()
+            bond.spy('concurrent', failures=len(result.failures) + len(result.errors), references=references,
+                     test_name=bond.current_session().test_name)
+        finally:
+            shutil.rmtree(observation_directory)
+
+    def test_float_format(self):
+        "The floats are formatted with the precision of the session, without changing the json module"
+        bond.settings(decimal_precision=2)
+        bond.spy('floats', values=[1.0 / 3, float('nan'), float('inf'), -float('inf')],
+                 json_dumps=json.dumps(1.0 / 3))
+
     def test_custom_serializer(self):
         bond.spy(obj=CustomClass(12, 87),
                  func=lambda x: True)
 
 
+class TurnTaking:
+    "Let threads take turns, in a fixed order"
+    def __init__(self, names):
+        self.names = names
+        self.turn = 0
+        self.condition = threading.Condition()
+
+    def wait_turn(self, name):
+        with self.condition:
+            while self.names[self.turn % len(self.names)] != name:
+                self.condition.wait()
+
+    def end_turn(self):
+        with self.condition:
+            self.turn += 1
+            self.condition.notify_all()
+
+
+class ConcurrentTest(unittest.TestCase):
+    "A test run by test_concurrent_sessions, with its own decimal precision"
+    def __init__(self, name, decimal_precision, observation_directory, turns):
+        unittest.TestCase.__init__(self, 'run_observations')
+        self.name = name
+        self.decimal_precision = decimal_precision
+        self.observation_directory = observation_directory
+        self.turns = turns
+
+    def setUp(self):
+        bond.start_test(self, test_name='Concurrent.' + self.name,
+                        observation_directory=self.observation_directory,
+                        decimal_precision=self.decimal_precision,
+                        reconcile='accept')
+
+    def run_observations(self):
+        for step in range(3):
+            self.turns.wait_turn(self.name)
+            bond.spy(self.name, step=step, value=step + 1.0 / 3)
+            self.turns.end_turn()
+
+
 class CustomClass:
     def __init__(self, arg1, args):
         self.arg1 = arg1
@@ -0,0 +1,55 @@
+import time
+import unittest
+
+import setup_paths_test
+from bond import bond
+from bond.bond_helpers import VirtualClock
+from bond_test import setup_bond_self_test
+
+
+class Poller:
+    """
+    A time-driven loop, like the HeatWatcher in the tutorial
+    """
+    def poll_loop(self, exit_time):
+        interval = 60
+        while self.get_current_time() < exit_time:
+            self.check()
+            self.sleep(interval)
+            interval = min(interval * 2, 3600)
+
+    @bond.spy_point(mock_only=True)
+    def get_current_time(self):
+        return time.time()
+
+    @bond.spy_point()
+    def check(self):
+        pass
+
+    @bond.spy_point()
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClockTest(unittest.TestCase):
+
+    def setUp(self):
+        setup_bond_self_test(self, ())
+
+    def test_spy_points(self):
+        "The sleeps advance the virtual clock, and are observed"
+        clock = VirtualClock(start_time=1000)
+        clock.deploy(time_points='Poller.get_current_time',
+                     sleep_points=['Poller.sleep'])
+        Poller().poll_loop(exit_time=1000 + 5 * 3600)
+        bond.spy('virtual_time', time=clock.time())
+
+    def test_patch_time(self):
+        "Patch time.time and time.sleep for the duration of the test"
+        original_time = time.time
+        clock = VirtualClock(start_time=50)
+        clock.deploy(patch_time=True)
+        time.sleep(3600)
+        bond.spy('patched_time', time=time.time())
+        clock.unpatch_time()
+        self.assertIs(original_time, time.time)